@@ -35,7 +35,7 @@ class BaseWizard(object):
     def __init__(self, config, path):
         super(BaseWizard, self).__init__()
         self.config = config
-        self.storage = WalletStorage(path)
+        self.storage = WalletStorage(path, config.get('wallet_engine'))
         self.wallet = None
         self.stack = []
         self.plugin = None
@@ -167,6 +167,30 @@ def op_push(i):
         return '4e' + int_to_hex(i,4)
 
 
+def var_int_size(i):
+    '''Length in bytes of var_int(i)'''
+    if i<0xfd:
+        return 1
+    elif i<=0xffff:
+        return 3
+    elif i<=0xffffffff:
+        return 5
+    else:
+        return 9
+
+
+def push_size(i):
+    '''Length in bytes of i bytes of data pushed with op_push'''
+    if i<0x4c:
+        return 1 + i
+    elif i<0xff:
+        return 2 + i
+    elif i<0xffff:
+        return 3 + i
+    else:
+        return 5 + i
+
+
 def sha256(x):
     return hashlib.sha256(x).digest()
 
@@ -387,8 +411,7 @@ def public_key_from_private_key(sec):
     pkey = regenerate_key(sec)
     assert pkey
     compressed = is_compressed(sec)
-    public_key = GetPubKey(pkey.pubkey, compressed)
-    return public_key.encode('hex')
+    return pkey.get_public_key(compressed)
 
 
 def address_from_private_key(sec):
@@ -456,15 +479,15 @@ def msg_magic(message):
 
 def verify_message(address, sig, message):
     try:
-        public_key, compressed = pubkey_from_signature(sig, message)
+        recid, compressed = parse_message_signature(sig)
+        h = Hash(msg_magic(message))
+        pubkey = ec_backend.recover(h, sig[1:], recid, compressed)
         # check public key using the address
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
-        addr = public_key_to_bc_address(pubkey)
-        if address != addr:
+        if pubkey is None or public_key_to_bc_address(pubkey) != address:
             raise Exception("Bad signature")
         # check message
-        h = Hash(msg_magic(message))
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ec_backend.verify(pubkey, h, sig[1:]):
+            raise Exception("Bad signature")
         return True
     except Exception as e:
         print_error("Verification error: {0}".format(e))
@@ -499,6 +522,12 @@ def negative_point(P):
     return Point( P.curve(), P.x(), -P.y(), P.order() )
 
 
+def compress_pubkey(K):
+    if K[0] != '\x04':
+        return K
+    return chr(2 + (ord(K[-1]) & 1)) + K[1:33]
+
+
 def point_to_ser(P, comp=True ):
     if comp:
         return ( ('%02x'%(2+(P.y()&1)))+('%064x'%P.x()) ).decode('hex')
@@ -545,7 +574,9 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         return klass.from_public_point( Q, curve )
 
 
-def pubkey_from_signature(sig, message):
+def parse_message_signature(sig):
+    '''Returns the recovery id and compression flag of a message
+    signature, from its header byte'''
     if len(sig) != 65:
         raise Exception("Wrong encoding")
     nV = ord(sig[0])
@@ -556,7 +587,11 @@ def pubkey_from_signature(sig, message):
         nV -= 4
     else:
         compressed = False
-    recid = nV - 27
+    return nV - 27, compressed
+
+
+def pubkey_from_signature(sig, message):
+    recid, compressed = parse_message_signature(sig)
     h = Hash(msg_magic(message))
     return MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1), compressed
 
@@ -574,22 +609,135 @@ class MySigningKey(ecdsa.SigningKey):
         return r, s
 
 
+class ECDSA_Backend(object):
+    '''EC operations in pure python, with the ecdsa package.  Keys are
+    serialized pubkeys and 32-byte secrets; signatures are 64 bytes r|s.'''
+
+    name = 'ecdsa'
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        return point_to_ser(generator_secp256k1 * string_to_number(secret), compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweaks):
+        '''Compressed pubkey + tweak*G, for each tweak'''
+        G = generator_secp256k1
+        P = ser_to_point(pubkey)
+        return [point_to_ser(string_to_number(t)*G + P, True) for t in tweaks]
+
+    def ecdh(self, pubkey, secret):
+        return point_to_ser(ser_to_point(pubkey) * string_to_number(secret), True)
+
+    def sign(self, secret, msg_hash):
+        private_key = MySigningKey.from_string(secret, curve = SECP256k1)
+        return private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
+
+    def verify(self, pubkey, msg_hash, sig):
+        try:
+            public_key = ecdsa.VerifyingKey.from_public_point(ser_to_point(pubkey), curve = SECP256k1)
+            return public_key.verify_digest(sig, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
+        except Exception:
+            return False
+
+    def recover(self, msg_hash, sig, recid, compressed):
+        try:
+            public_key = MyVerifyingKey.from_signature(sig, recid, msg_hash, curve = SECP256k1)
+        except Exception:
+            return None
+        return point_to_ser(public_key.pubkey.point, compressed)
+
+
+class Secp256k1_Backend(ECDSA_Backend):
+    '''libsecp256k1 through ctypes.  Pubkey recovery falls back to ecdsa
+    if the library was built without the recovery module.'''
+
+    name = 'libsecp256k1'
+
+    def __init__(self, lib):
+        self.lib = lib
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        return self.lib.pubkey_from_secret(secret, compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweaks):
+        return self.lib.pubkey_tweak_add(pubkey, tweaks)
+
+    def ecdh(self, pubkey, secret):
+        return self.lib.pubkey_tweak_mul(pubkey, secret)
+
+    def sign(self, secret, msg_hash):
+        return self.lib.sign(secret, msg_hash)
+
+    def verify(self, pubkey, msg_hash, sig):
+        return self.lib.verify(pubkey, msg_hash, sig)
+
+    def recover(self, msg_hash, sig, recid, compressed):
+        if not self.lib.has_recovery:
+            return ECDSA_Backend.recover(self, msg_hash, sig, recid, compressed)
+        return self.lib.recover(msg_hash, sig, recid, compressed)
+
+
+def load_ec_backend(name=None):
+    '''The ecdsa backend, unless name is 'libsecp256k1'.  The library
+    is only looked up when asked for, with the ec_backend config key.'''
+    if name == 'libsecp256k1':
+        import libsecp256k1
+        lib = libsecp256k1.load()
+        if lib is None:
+            raise Exception('libsecp256k1 is not available')
+        return Secp256k1_Backend(lib)
+    if name not in [None, 'ecdsa']:
+        raise Exception('unknown EC backend: %s' % name)
+    return ECDSA_Backend()
+
+
+def available_ec_backends():
+    import libsecp256k1
+    names = ['ecdsa']
+    if libsecp256k1.load() is not None:
+        names.insert(0, 'libsecp256k1')
+    return names
+
+
+def set_ec_backend(name=None):
+    global ec_backend
+    ec_backend = load_ec_backend(name)
+    print_error("[bitcoin] EC backend:", ec_backend.name)
+    return ec_backend
+
+
 class EC_KEY(object):
 
     def __init__( self, k ):
-        secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
-        self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
-        self.secret = secret
+        self.secret = string_to_number(k)
+        self.secret_bytes = number_to_string(self.secret, generator_secp256k1.order())
+        self.pubkey_ser = ec_backend.pubkey_from_secret(self.secret_bytes, False)
+        self._pubkey = None
+
+    @property
+    def pubkey(self):
+        '''ecdsa Public_key, for callers working with points'''
+        if self._pubkey is None:
+            point = ser_to_point(self.pubkey_ser)
+            self._pubkey = ecdsa.ecdsa.Public_key(generator_secp256k1, point)
+        return self._pubkey
+
+    @property
+    def privkey(self):
+        return ecdsa.ecdsa.Private_key(self.pubkey, self.secret)
 
     def get_public_key(self, compressed=True):
-        return point_to_ser(self.pubkey.point, compressed).encode('hex')
-
-    def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
+        if compressed:
+            return compress_pubkey(self.pubkey_ser).encode('hex')
+        return self.pubkey_ser.encode('hex')
+
+    def sign(self, msg_hash, sigencode=ecdsa.util.sigencode_string, verify=True):
+        signature = ec_backend.sign(self.secret_bytes, msg_hash)
+        if verify:
+            assert ec_backend.verify(self.pubkey_ser, msg_hash, signature)
+        if sigencode is not ecdsa.util.sigencode_string:
+            order = generator_secp256k1.order()
+            r, s = ecdsa.util.sigdecode_string(signature, order)
+            signature = sigencode(r, s, order)
         return signature
 
     def sign_message(self, message, is_compressed):
@@ -606,13 +754,15 @@ class EC_KEY(object):
 
 
     def verify_message(self, sig, message):
-        public_key, compressed = pubkey_from_signature(sig, message)
+        recid, compressed = parse_message_signature(sig)
+        h = Hash(msg_magic(message))
+        pubkey = ec_backend.recover(h, sig[1:], recid, compressed)
         # check public key
-        if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
+        if pubkey is None or pubkey.encode('hex') != self.get_public_key(compressed):
             raise Exception("Bad signature")
         # check message
-        h = Hash(msg_magic(message))
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ec_backend.verify(pubkey, h, sig[1:]):
+            raise Exception("Bad signature")
 
 
     # ECIES encryption/decryption methods; AES-128-CBC with PKCS7 is used as the cipher; hmac-sha256 is used as the mac
@@ -626,7 +776,7 @@ class EC_KEY(object):
 
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        ecdh_key = ec_backend.ecdh(pubkey, ephemeral.secret_bytes)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -660,7 +810,7 @@ class EC_KEY(object):
         if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
 
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        ecdh_key = ec_backend.ecdh(encrypted[4:37], self.secret_bytes)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -669,6 +819,9 @@ class EC_KEY(object):
         return aes_decrypt_with_iv(key_e, iv, ciphertext)
 
 
+ec_backend = ECDSA_Backend()
+
+
 ###################################### BIP32 ##############################
 
 random_seed = lambda n: "%032x"%ecdsa.util.randrange( pow(2,n) )
@@ -677,11 +830,8 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
-    return K, K_compressed
+    K = ec_backend.pubkey_from_secret(secret, False)
+    return K[1:], compress_pubkey(K)
 
 
 # Child private key derivation function (from master private key)
@@ -698,8 +848,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = ec_backend.pubkey_from_secret(k, True)
     data = chr(0) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -718,15 +867,21 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = ec_backend.pubkey_tweak_add(cK, [I[0:32]])[0]
     return cK_n, c_n
 
+def CKD_pub_batch(cK, c, sequence):
+    '''Public children of (cK, c) for each index of sequence.  The
+    parent point is decoded once per batch.'''
+    tweaks = []
+    for n in sequence:
+        if n & BIP32_PRIME: raise
+        I = hmac.new(c, cK + rev_hex(int_to_hex(n,4)).decode('hex'), hashlib.sha512).digest()
+        tweaks.append(I[0:32])
+    return ec_backend.pubkey_tweak_add(cK, tweaks)
+
 
 def deserialize_xkey(xkey):
     xkey = DecodeBase58Check(xkey)
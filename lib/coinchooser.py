@@ -23,8 +23,10 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from bisect import bisect_left
 from collections import defaultdict, namedtuple
 from math import floor, log10
+import time
 
 from bitcoin import sha256, COIN, TYPE_ADDRESS
 from transaction import Transaction
@@ -70,6 +72,8 @@ class PRNG:
 
 
 Bucket = namedtuple('Bucket', ['desc', 'size', 'value', 'coins'])
+# What a make_tx call has to pay, for choosers that work on effective values
+Spend = namedtuple('Spend', ['base_size', 'spent_amount', 'fee_estimator', 'dust_threshold'])
 
 def strip_unneeded(bkts, sufficient_funds):
     '''Remove buckets that are unnecessary in achieving the spend amount'''
@@ -192,8 +196,9 @@ class CoinChooserBase(PrintError):
 
         # Collect the coins into buckets, choose a subset of the buckets
         buckets = self.bucketize_coins(coins)
+        spend = Spend(base_size, spent_amount, fee_estimator, dust_threshold)
         buckets = self.choose_buckets(buckets, sufficient_funds,
-                                      self.penalty_func(tx))
+                                      self.penalty_func(tx), spend)
 
         tx.add_inputs([coin for b in buckets for coin in b.coins])
         tx_size = base_size + sum(bucket.size for bucket in buckets)
@@ -220,7 +225,7 @@ class CoinChooserOldestFirst(CoinChooserBase):
         return [coin['prevout_hash'] + ':' + str(coin['prevout_n'])
                 for coin in coins]
 
-    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, spend):
         '''Spend the oldest buckets first.'''
         # Unconfirmed coins are young, not old
         adj_height = lambda height: 99999999 if height == 0 else height
@@ -264,7 +269,7 @@ class CoinChooserRandom(CoinChooserBase):
         candidates = [[buckets[n] for n in c] for c in candidates]
         return [strip_unneeded(c, sufficient_funds) for c in candidates]
 
-    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, spend):
         candidates = self.bucket_candidates(buckets, sufficient_funds)
         penalties = [penalty_func(cand) for cand in candidates]
         winner = candidates[penalties.index(min(penalties))]
@@ -306,8 +311,103 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+def branch_and_bound(values, target, upper, max_tries, deadline):
+    '''Depth-first search for a subset of values, sorted in decreasing
+    order, whose sum is in [target, upper].  Returns the indexes of the
+    subset with the smallest sum found before max_tries steps or the
+    deadline, or None.'''
+    n = len(values)
+    remaining = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + values[i]
+    best, best_total = None, upper + 1
+    selected = []
+    total = 0
+    i = 0
+    for tries in xrange(max_tries):
+        if tries % 1000 == 999 and time.time() > deadline:
+            break
+        if total >= target or i == n or total + remaining[i] < target:
+            if target <= total < best_total:
+                best, best_total = list(selected), total
+                if total == target:
+                    break
+            # backtrack: exclude the last included value
+            if not selected:
+                break
+            j = selected.pop()
+            total -= values[j]
+            i = j + 1
+            continue
+        selected.append(i)
+        total += values[i]
+        i += 1
+    return best
+
+class CoinChooserBranchAndBound(CoinChooserBase):
+    '''Scales to large numbers of coins.  Coins are grouped by address
+    and sorted by effective value (value minus the fee of spending
+    them).  A branch-and-bound search looks, within a time budget, for
+    buckets that pay the outputs without needing change; otherwise
+    the largest buckets are taken, completed by the smallest bucket
+    that covers the rest.'''
+
+    max_tries = 100000
+    time_budget = 0.25
+
+    def keys(self, coins):
+        return [coin['address'] for coin in coins]
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, spend):
+        fee = spend.fee_estimator
+        base_fee = fee(spend.base_size)
+        target = spend.spent_amount + base_fee
+        # a change output costs its fee, and is dropped below the dust
+        # threshold: a selection this close to the target needs none
+        upper = target + fee(spend.base_size + 34) - base_fee + spend.dust_threshold
+        pool = []
+        for b in buckets:
+            v = b.value - (fee(spend.base_size + b.size) - base_fee)
+            if v > 0:
+                pool.append((v, b.desc, b))
+        pool.sort()
+        values = [x[0] for x in pool]
+        self.print_error("Bucket sets:", len(pool))
+
+        deadline = time.time() + self.time_budget
+        indexes = branch_and_bound(values[::-1], target, upper, self.max_tries, deadline)
+        if indexes is not None:
+            selected = [pool[len(pool) - 1 - i][2] for i in indexes]
+            if sufficient_funds(selected):
+                self.print_error("exact match:", len(selected), "buckets")
+                return selected
+
+        # greedy: the largest buckets, then the smallest that completes them
+        selected = []
+        total = 0
+        hi = len(pool)
+        while total < target and hi > 0:
+            k = bisect_left(values, target - total, 0, hi)
+            if k < hi:
+                selected.append(pool[k][2])
+                del pool[k], values[k]
+                hi -= 1
+                break
+            hi -= 1
+            selected.append(pool[hi][2])
+            total += values[hi]
+        # the fee may not be linear in the size
+        while not sufficient_funds(selected):
+            if hi == 0:
+                raise NotEnoughFunds()
+            hi -= 1
+            selected.append(pool[hi][2])
+        return selected
+
+
 COIN_CHOOSERS = {'Priority': CoinChooserOldestFirst,
-                 'Privacy': CoinChooserPrivacy}
+                 'Privacy': CoinChooserPrivacy,
+                 'Branch-and-bound': CoinChooserBranchAndBound}
 
 def get_name(config):
     kind = config.get('coin_chooser')
@@ -127,6 +127,14 @@ class Commands:
         self.wallet.storage.write()
         return {'password':self.wallet.use_encryption}
 
+    @command('w')
+    def convertwallet(self):
+        """Convert the wallet file to the sqlite storage engine. """
+        storage = self.wallet.storage
+        storage.engine = 'sqlite'
+        storage.convert_engine()
+        return storage.is_sqlite()
+
     @command('')
     def getconfig(self, key):
         """Return a configuration variable. """
@@ -183,6 +183,7 @@ class Daemon(DaemonThread):
                     'blockchain_height': self.network.get_local_height(),
                     'server_height': self.network.get_server_height(),
                     'spv_nodes': len(self.network.get_interfaces()),
+                    'pipeline': self.network.get_status_value('pipeline'),
                     'connected': self.network.is_connected(),
                     'auto_connect': p[4],
                     'version': ELECTRUM_VERSION,
@@ -215,7 +216,7 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
-        storage = WalletStorage(path)
+        storage = WalletStorage(path, self.config.get('wallet_engine'))
         if not storage.file_exists:
             return
         if storage.requires_split():
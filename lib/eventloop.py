@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Event loop of the network thread.
+
+Sockets are watched with epoll, poll or select, whichever the platform
+has.  Other threads interrupt the wait with wakeup(), which writes to
+a socket pair watched by the loop, and call_later() schedules timers,
+so the loop sleeps until there is something to do.
+'''
+
+import errno
+import heapq
+import math
+import select
+import socket
+import threading
+import time
+import Queue
+
+from util import PrintError
+
+
+READ = 1
+WRITE = 2
+
+
+def socket_pair():
+    '''Connected pair of sockets.  Windows has no socketpair(), and
+    cannot select on pipes, so a loopback connection is used there.'''
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        pass
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        w = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        w.connect(listener.getsockname())
+        r, addr = listener.accept()
+        return r, w
+    finally:
+        listener.close()
+
+
+class EpollPoller(object):
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def events(self, mask):
+        return ((select.EPOLLIN if mask & READ else 0)
+                | (select.EPOLLOUT if mask & WRITE else 0))
+
+    def register(self, fd, mask):
+        self.epoll.register(fd, self.events(mask))
+
+    def modify(self, fd, mask):
+        self.epoll.modify(fd, self.events(mask))
+
+    def unregister(self, fd):
+        # closed file descriptors are removed by the kernel
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        out = []
+        for fd, ev in self.epoll.poll(timeout):
+            # errors and hangups are reported as readable, recv() tells
+            mask = READ if ev & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP) else 0
+            if ev & select.EPOLLOUT:
+                mask |= WRITE
+            out.append((fd, mask))
+        return out
+
+    def close(self):
+        self.epoll.close()
+
+
+class PollPoller(object):
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def events(self, mask):
+        return ((select.POLLIN if mask & READ else 0)
+                | (select.POLLOUT if mask & WRITE else 0))
+
+    def register(self, fd, mask):
+        self.poller.register(fd, self.events(mask))
+
+    def modify(self, fd, mask):
+        self.poller.modify(fd, self.events(mask))
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        out = []
+        for fd, ev in self.poller.poll(int(math.ceil(timeout * 1000))):
+            mask = READ if ev & (select.POLLIN | select.POLLERR | select.POLLHUP | select.POLLNVAL) else 0
+            if ev & select.POLLOUT:
+                mask |= WRITE
+            out.append((fd, mask))
+        return out
+
+    def close(self):
+        pass
+
+
+class SelectPoller(object):
+
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, mask):
+        self.fds[fd] = mask
+
+    modify = register
+
+    def unregister(self, fd):
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout):
+        rin = [fd for fd, mask in self.fds.items() if mask & READ]
+        win = [fd for fd, mask in self.fds.items() if mask & WRITE]
+        rout, wout, xout = select.select(rin, win, [], timeout)
+        out = dict((fd, READ) for fd in rout)
+        for fd in wout:
+            out[fd] = out.get(fd, 0) | WRITE
+        return out.items()
+
+    def close(self):
+        pass
+
+
+def make_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+
+class EventLoop(PrintError):
+    '''Waits on sockets, wakeups from other threads, and timers.
+    select() and run_timers() must be called from the loop thread;
+    wakeup() and call_later() can be called from any thread.'''
+
+    def __init__(self):
+        self.poller = make_poller()
+        # fd -> (object, mask) of the sockets being watched
+        self.watched = {}
+        # heap of [time, sequence number, callback]
+        self.timers = []
+        self.timer_seq = 0
+        self.lock = threading.Lock()
+        self.woken = False
+        self.wakeup_r, self.wakeup_w = socket_pair()
+        self.wakeup_r.setblocking(0)
+        self.wakeup_w.setblocking(0)
+        self.poller.register(self.wakeup_r.fileno(), READ)
+        self.print_error("using", self.poller.__class__.__name__)
+
+    def diagnostic_name(self):
+        return 'eventloop'
+
+    def wakeup(self):
+        '''Interrupt the current or next wait of the loop'''
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.wakeup_w.send('\0')
+        except socket.error:
+            pass
+
+    def clear_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+        # cleared after draining, so that a concurrent wakeup is not lost
+        with self.lock:
+            self.woken = False
+
+    def call_later(self, delay, callback):
+        '''Call callback from the loop thread after delay seconds.
+        Returns a timer that can be passed to cancel().'''
+        with self.lock:
+            self.timer_seq += 1
+            timer = [time.time() + delay, self.timer_seq, callback]
+            heapq.heappush(self.timers, timer)
+            first = self.timers[0] is timer
+        if first:
+            self.wakeup()
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def next_timeout(self, timeout):
+        with self.lock:
+            if self.timers:
+                timeout = min(timeout, max(0, self.timers[0][0] - time.time()))
+        return timeout
+
+    def run_timers(self):
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+        for callback in filter(None, due):
+            callback()
+
+    def watch(self, rlist, wlist):
+        '''Update the poller with the objects to watch'''
+        wset = set(wlist)
+        wanted = {}
+        for obj in rlist:
+            wanted[obj.fileno()] = (obj, READ | (WRITE if obj in wset else 0))
+        for fd, (obj, mask) in self.watched.items():
+            if wanted.get(fd, (None,))[0] is not obj:
+                # gone, or a new socket reusing the descriptor
+                self.poller.unregister(fd)
+                del self.watched[fd]
+        for fd, (obj, mask) in wanted.items():
+            old = self.watched.get(fd)
+            if old is None:
+                self.poller.register(fd, mask)
+            elif old[1] != mask:
+                self.poller.modify(fd, mask)
+        self.watched = wanted
+
+    def select(self, rlist, wlist, timeout):
+        '''Like select.select(rlist, wlist, [], timeout), waiting at most
+        until the next timer, and returning early on wakeup().  Objects
+        in wlist must also be in rlist.'''
+        self.watch(rlist, wlist)
+        try:
+            events = self.poller.poll(self.next_timeout(timeout))
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return [], []
+            raise
+        rout, wout = [], []
+        wakeup_fd = self.wakeup_r.fileno()
+        for fd, mask in events:
+            if fd == wakeup_fd:
+                self.clear_wakeup()
+                continue
+            obj = self.watched.get(fd, (None,))[0]
+            if obj is None:
+                continue
+            if mask & READ:
+                rout.append(obj)
+            if mask & WRITE:
+                wout.append(obj)
+        return rout, wout
+
+    def close(self):
+        self.poller.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+
+class WakeupQueue(Queue.Queue):
+    '''Queue that wakes up an event loop when an item is put'''
+
+    def __init__(self, loop):
+        Queue.Queue.__init__(self)
+        self.loop = loop
+
+    def put(self, item, block=True, timeout=None):
+        Queue.Queue.put(self, item, block, timeout)
+        self.loop.wakeup()
@@ -215,10 +215,16 @@ class Interface(util.PrintError):
     electrum server.  It's exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
-    - Member variable server.
+      pipeline_stats(), queue_request(), send_requests()
+    - Member variables server, use_batches.
     """
 
+    # bounds of the number of unanswered requests
+    MIN_WINDOW = 10
+    MAX_WINDOW = 5000
+    # requests per JSON-RPC batch
+    MAX_BATCH = 100
+
     def __init__(self, server, socket):
         self.server = server
         self.host, _, _ = server.split(':')
@@ -230,10 +236,22 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
-        # Set last ping to zero to ensure immediate ping
+        self.send_times = {}
+        # wire ids of the batches sent, in order, while some are unanswered
+        self.unanswered_batches = []
         self.last_request = time.time()
-        self.last_ping = 0
         self.closed_remotely = False
+        # Send requests as JSON-RPC batches; set by the network once
+        # the server version is known
+        self.use_batches = False
+        # Window of unanswered requests, adapted to round trip times
+        self.window = 100
+        self.slow_start = True
+        self.rtt = None
+        self.min_rtt = None
+        self.round_responses = 0
+        self.requests_sent = 0
+        self.batches_sent = 0
 
     def diagnostic_name(self):
         return self.host
@@ -258,36 +276,100 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests below the window'''
+        n = self.window - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
+
+    def wants_write(self):
+        '''True if there are requests to send, or data the socket did
+        not take yet'''
+        return bool(self.pipe.unsent or self.num_requests())
 
     def send_requests(self):
-        '''Sends queued requests.  Returns False on failure.'''
+        '''Sends queued requests without blocking; what the socket does
+        not take is sent by later calls, once it is writable.  Returns
+        False on failure.'''
         make_dict = lambda (m, p, i): {'method': m, 'params': p, 'id': i}
-        n = self.num_requests()
-        wire_requests = self.unsent_requests[0:n]
         try:
-            self.pipe.send_all(map(make_dict, wire_requests))
+            if not self.pipe.flush():
+                return True
         except socket.error, e:
             self.print_error("socket error:", e)
             return False
+        n = self.num_requests()
+        if not n:
+            return True
+        wire_requests = self.unsent_requests[0:n]
+        batches = self.use_batches and n > 1
+        if batches:
+            out = [map(make_dict, wire_requests[i:i+self.MAX_BATCH])
+                   for i in range(0, n, self.MAX_BATCH)]
+        else:
+            out = map(make_dict, wire_requests)
+        self.pipe.queue_all(out)
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = now
+        self.requests_sent += n
+        if batches:
+            self.batches_sent += len(out)
+            self.unanswered_batches = [ids for ids in self.unanswered_batches
+                                       if any(i in self.unanswered_requests for i in ids)]
+            self.unanswered_batches.extend([r['id'] for r in batch] for batch in out)
+        try:
+            self.pipe.flush()
+        except socket.error, e:
+            self.print_error("socket error:", e)
+            return False
         return True
 
-    def ping_required(self):
-        '''Maintains time since last ping.  Returns True if a ping should
-        be sent.
-        '''
-        now = time.time()
-        if now - self.last_ping > 60:
-            self.last_ping = now
-            return True
-        return False
+    def fail_batch(self, error):
+        '''Answers the unanswered requests of the oldest batch with an
+        error the server returned for a whole batch.  Returns the
+        (request, response) pairs, or None if no batch is unanswered.'''
+        while self.unanswered_batches:
+            ids = self.unanswered_batches.pop(0)
+            requests = filter(None, [self.unanswered_requests.pop(i, None) for i in ids])
+            if requests:
+                for request in requests:
+                    self.send_times.pop(request[2], None)
+                return [(request, {'id': request[2], 'error': error}) for request in requests]
+        return None
+
+    def update_window(self, rtt):
+        '''The window grows while round trips stay close to the fastest
+        seen, that is while the server answers as fast as we send, and
+        shrinks when requests queue up at the server.  It is adapted
+        once per window of responses.'''
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        self.round_responses += 1
+        if self.round_responses < self.window:
+            return
+        self.round_responses = 0
+        if self.rtt > max(2 * self.min_rtt, self.min_rtt + 0.05):
+            self.slow_start = False
+            self.window = max(self.MIN_WINDOW, self.window * 3 / 4)
+        elif self.unsent_requests:
+            # only grow a window that limits the requests sent
+            growth = 2 if self.slow_start else 1.25
+            self.window = min(self.MAX_WINDOW, int(self.window * growth))
+
+    def pipeline_stats(self):
+        return {
+            'window': self.window,
+            'unanswered': len(self.unanswered_requests),
+            'unsent': len(self.unsent_requests),
+            'rtt': round(self.rtt, 4) if self.rtt is not None else None,
+            'min_rtt': round(self.min_rtt, 4) if self.min_rtt is not None else None,
+            'batches': self.use_batches,
+            'requests_sent': self.requests_sent,
+            'batches_sent': self.batches_sent,
+        }
 
     def has_timed_out(self):
         '''Returns True if the interface has timed out.'''
@@ -318,19 +400,37 @@ class Interface(util.PrintError):
                 self.closed_remotely = True
                 self.print_error("connection closed remotely")
                 break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
-            else:
+            # a JSON-RPC batch response is a list of responses
+            batch = response if isinstance(response, list) else [response]
+            for response in batch:
+                if self.debug:
+                    self.print_error("<--", response)
+                if not isinstance(response, dict):
+                    self.print_error("invalid response", response)
+                    responses.append((None, None)) # Signal
+                    return responses
+                wire_id = response.get('id', None)
+                if wire_id is None and 'error' in response and 'method' not in response:
+                    # the server could not read a batch
+                    failed = self.fail_batch(response['error'])
+                    if failed is None:
+                        self.print_error("error", response['error'])
+                        responses.append((None, None)) # Signal
+                        return responses
+                    self.print_error("batch error", response['error'])
+                    responses.extend(failed)
+                    continue
+                if wire_id is None:  # Notification
+                    responses.append((None, response))
+                    continue
                 request = self.unanswered_requests.pop(wire_id, None)
                 if request:
                     responses.append((request, response))
+                    self.update_window(time.time() - self.send_times.pop(wire_id))
                 else:
                     self.print_error("unknown wire ID", wire_id)
                     responses.append((None, None)) # Signal
-                    break
+                    return responses
 
         return responses
 
@@ -225,19 +225,33 @@ class Xpub:
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        # for_change -> (chain code, compressed pubkey) of the branch
+        self.branch_keys = {}
 
     def get_master_public_key(self):
         return self.xpub
 
+    def get_branch_key(self, for_change):
+        key = self.branch_keys.get(for_change)
+        if key is None:
+            xpub = self.xpub_change if for_change else self.xpub_receive
+            if xpub is None:
+                xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
+                if for_change:
+                    self.xpub_change = xpub
+                else:
+                    self.xpub_receive = xpub
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            key = self.branch_keys[for_change] = (c, cK)
+        return key
+
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return self.derive_pubkeys(for_change, n, 1)[0]
+
+    def derive_pubkeys(self, for_change, n, count):
+        '''Pubkeys n..n+count-1 of a branch'''
+        c, cK = self.get_branch_key(for_change)
+        return [x.encode('hex') for x in bitcoin.CKD_pub_batch(cK, c, range(n, n + count))]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -412,6 +426,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, n, count):
+        return [self.derive_pubkey(for_change, i) for i in range(n, n + count)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
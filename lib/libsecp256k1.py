@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+ctypes bindings of libsecp256k1.
+
+load() returns a LibSecp256k1 instance, or None if the library is not
+installed.  Its methods take and return byte strings and integers;
+the EC backend built on it is in bitcoin.py.  Pubkey recovery needs a
+library built with the recovery module; has_recovery tells whether it
+is available.
+'''
+
+import os
+import ctypes
+import ctypes.util
+from ctypes import byref, c_char_p, c_int, c_size_t, c_uint, c_void_p, create_string_buffer
+
+from util import print_error
+
+
+SECP256K1_CONTEXT_VERIFY = (1 << 0) | (1 << 8)
+SECP256K1_CONTEXT_SIGN = (1 << 0) | (1 << 9)
+SECP256K1_EC_COMPRESSED = (1 << 1) | (1 << 8)
+SECP256K1_EC_UNCOMPRESSED = (1 << 1)
+
+LIBRARY_NAMES = ['libsecp256k1.so.0', 'libsecp256k1.so', 'libsecp256k1.dylib', 'libsecp256k1.dll']
+
+
+def find_library():
+    here = os.path.dirname(os.path.abspath(__file__))
+    candidates = [os.path.join(here, name) for name in LIBRARY_NAMES]
+    path = ctypes.util.find_library('secp256k1')
+    if path:
+        candidates.append(path)
+    candidates.extend(LIBRARY_NAMES)
+    for name in candidates:
+        try:
+            return ctypes.CDLL(name)
+        except OSError:
+            continue
+
+
+class LibSecp256k1(object):
+
+    def __init__(self, lib):
+        self.lib = lib
+        lib.secp256k1_context_create.argtypes = [c_uint]
+        lib.secp256k1_context_create.restype = c_void_p
+        for name, argtypes in [
+                ('secp256k1_context_randomize', [c_void_p, c_char_p]),
+                ('secp256k1_ec_pubkey_create', [c_void_p, c_char_p, c_char_p]),
+                ('secp256k1_ec_pubkey_parse', [c_void_p, c_char_p, c_char_p, c_size_t]),
+                ('secp256k1_ec_pubkey_serialize', [c_void_p, c_char_p, c_void_p, c_char_p, c_uint]),
+                ('secp256k1_ec_pubkey_tweak_add', [c_void_p, c_char_p, c_char_p]),
+                ('secp256k1_ec_pubkey_tweak_mul', [c_void_p, c_char_p, c_char_p]),
+                ('secp256k1_ecdsa_sign', [c_void_p, c_char_p, c_char_p, c_char_p, c_void_p, c_void_p]),
+                ('secp256k1_ecdsa_verify', [c_void_p, c_char_p, c_char_p, c_char_p]),
+                ('secp256k1_ecdsa_signature_parse_compact', [c_void_p, c_char_p, c_char_p]),
+                ('secp256k1_ecdsa_signature_serialize_compact', [c_void_p, c_char_p, c_char_p]),
+                ('secp256k1_ecdsa_signature_normalize', [c_void_p, c_char_p, c_char_p])]:
+            f = getattr(lib, name)
+            f.argtypes = argtypes
+            f.restype = c_int
+        self.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+        if not lib.secp256k1_context_randomize(self.ctx, os.urandom(32)):
+            raise Exception('secp256k1_context_randomize failed')
+        try:
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p, c_int]
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.restype = c_int
+            lib.secp256k1_ecdsa_recover.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
+            lib.secp256k1_ecdsa_recover.restype = c_int
+            self.has_recovery = True
+        except AttributeError:
+            self.has_recovery = False
+
+    def parse_pubkey(self, pubkey):
+        p = create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, p, pubkey, len(pubkey)):
+            raise Exception('invalid public key')
+        return p
+
+    def serialize_pubkey(self, p, compressed):
+        size = c_size_t(33 if compressed else 65)
+        out = create_string_buffer(size.value)
+        flags = SECP256K1_EC_COMPRESSED if compressed else SECP256K1_EC_UNCOMPRESSED
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, byref(size), p, flags)
+        return out.raw[:size.value]
+
+    def pubkey_from_secret(self, secret, compressed):
+        p = create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, p, secret):
+            raise Exception('invalid secret')
+        return self.serialize_pubkey(p, compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweaks):
+        out = []
+        for tweak in tweaks:
+            p = self.parse_pubkey(pubkey)
+            if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, p, tweak):
+                raise Exception('invalid tweak')
+            out.append(self.serialize_pubkey(p, True))
+        return out
+
+    def pubkey_tweak_mul(self, pubkey, tweak, compressed=True):
+        p = self.parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_mul(self.ctx, p, tweak):
+            raise Exception('invalid tweak')
+        return self.serialize_pubkey(p, compressed)
+
+    def sign(self, secret, msg_hash):
+        '''Deterministic (RFC6979) low-S signature, as 64 bytes r|s'''
+        sig = create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, msg_hash, secret, None, None):
+            raise Exception('signing failed')
+        out = create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_signature_serialize_compact(self.ctx, out, sig)
+        return out.raw
+
+    def verify(self, pubkey, msg_hash, compact_sig):
+        sig = create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_signature_parse_compact(self.ctx, sig, compact_sig):
+            return False
+        # libsecp256k1 only accepts low-S signatures
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, sig, sig)
+        try:
+            p = self.parse_pubkey(pubkey)
+        except Exception:
+            return False
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, sig, msg_hash, p) == 1
+
+    def recover(self, msg_hash, compact_sig, recid, compressed):
+        sig = create_string_buffer(65)
+        if not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(self.ctx, sig, compact_sig, recid):
+            return None
+        p = create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, p, sig, msg_hash):
+            return None
+        return self.serialize_pubkey(p, compressed)
+
+
+def load():
+    lib = find_library()
+    if lib is None:
+        return None
+    try:
+        return LibSecp256k1(lib)
+    except Exception as e:
+        print_error("[libsecp256k1] cannot use library:", e)
+        return None
@@ -27,7 +27,6 @@ import os
 import errno
 import sys
 import random
-import select
 import traceback
 from collections import defaultdict, deque
 from threading import Lock
@@ -40,7 +39,10 @@ import util
 import bitcoin
 from bitcoin import *
 from interface import Connection, Interface
+from eventloop import EventLoop, WakeupQueue
+import blockchain
 from blockchain import Blockchain
+from verifier import MerkleCache
 from version import ELECTRUM_VERSION, PROTOCOL_VERSION
 
 DEFAULT_PORTS = {'t':'50003', 's':'50004'}
@@ -60,6 +62,9 @@ def set_testnet():
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+PING_INTERVAL = 60
+# longest wait of the network loop, for jobs and timeouts
+JOBS_INTERVAL = 1
 
 
 def parse_servers(result):
@@ -167,8 +172,18 @@ class Network(util.DaemonThread):
         self.config = SimpleConfig(config) if type(config) == type({}) else config
         self.num_server = 8 if not self.config.get('oneserver') else 0
         self.blockchain = Blockchain(self.config, self)
+        # Verified merkle branches, shared by the wallets of the daemon
+        self.merkle_cache = MerkleCache(os.path.join(self.config.path, 'merkle_cache')
+                                        if self.config.path else None,
+                                        max_size=self.config.get('merkle_cache_size', 100000))
         # A deque of interface header requests, processed left-to-right
         self.bc_requests = deque()
+        # Pipelined chunk download: chunk index -> interface for
+        # requests in flight, and chunk index -> pending validation
+        self.chunk_pipeline = self.config.get('chunk_pipeline', 8)
+        self.requested_chunks = {}
+        self.chunk_results = {}
+        self.chunk_pool = None
         # Server for addresses and transactions
         self.default_server = self.config.get('server')
         # Sanitize default server
@@ -206,9 +221,8 @@ class Network(util.DaemonThread):
         self.subscribed_addresses = set()
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
-        # retry times
-        self.server_retry_time = time.time()
-        self.nodes_retry_time = time.time()
+        # sockets, wakeups from other threads and timers
+        self.loop = EventLoop()
         # kick off the network.  interface is the main server we are currently
         # communicating with.  interfaces is the set of servers we are connecting
         # to or have an ongoing connection with
@@ -216,7 +230,7 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.socket_queue = Queue.Queue()
+        self.socket_queue = WakeupQueue(self.loop)
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
@@ -328,6 +342,9 @@ class Network(util.DaemonThread):
             value = self.get_servers()
         elif key == 'interfaces':
             value = self.get_interfaces()
+        elif key == 'pipeline':
+            value = dict((server, i.pipeline_stats())
+                         for server, i in self.interfaces.items())
         return value
 
     def notify(self, key):
@@ -411,7 +428,7 @@ class Network(util.DaemonThread):
         assert not self.interfaces
         self.connecting = set()
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = Queue.Queue()
+        self.socket_queue = WakeupQueue(self.loop)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
@@ -496,6 +513,7 @@ class Network(util.DaemonThread):
         # We handle some responses; return the rest to the client.
         if method == 'server.version':
             interface.server_version = result
+            interface.use_batches = self.use_batches(result)
         elif method == 'blockchain.headers.subscribe':
             if error is None:
                 self.on_header(interface, result)
@@ -579,6 +597,7 @@ class Network(util.DaemonThread):
         '''Messages is a list of (method, params) tuples'''
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.loop.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -630,14 +649,42 @@ class Network(util.DaemonThread):
             self.heights.pop(server, None)
             self.notify('interfaces')
 
+    def use_batches(self, server_version):
+        '''Requests are sent as JSON-RPC batches to servers known to
+        support them, unless the 'batch_requests' setting says otherwise'''
+        batches = self.config.get('batch_requests')
+        if batches is not None:
+            return bool(batches)
+        return isinstance(server_version, basestring) and server_version.startswith('ElectrumX')
+
     def new_interface(self, server, socket):
         self.add_recent_server(server)
         self.interfaces[server] = interface = Interface(server, socket)
         self.queue_request('blockchain.headers.subscribe', [], interface)
+        self.ping_interface(interface)
         if server == self.default_server:
             self.switch_to_interface(server)
         self.notify('interfaces')
 
+    def ping_interface(self, interface):
+        '''Keeps the connection alive while the interface is up'''
+        if self.interfaces.get(interface.server) is not interface:
+            return
+        params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
+        self.queue_request('server.version', params, interface)
+        self.loop.call_later(PING_INTERVAL, lambda: self.ping_interface(interface))
+
+    def retry_nodes(self):
+        if len(self.interfaces) + len(self.connecting) < self.num_server:
+            self.print_error('network: retrying connections')
+            self.disconnected_servers = set([])
+        self.loop.call_later(NODES_RETRY_INTERVAL, self.retry_nodes)
+
+    def retry_server(self):
+        if not self.is_connected() and not self.auto_connect:
+            self.disconnected_servers.discard(self.default_server)
+        self.loop.call_later(SERVER_RETRY_INTERVAL, self.retry_server)
+
     def maintain_sockets(self):
         '''Socket maintenance.'''
         # Responses to connection attempts?
@@ -649,56 +696,151 @@ class Network(util.DaemonThread):
             else:
                 self.connection_down(server)
 
-        # Send pings and shut down stale interfaces
+        # Shut down stale interfaces; pings and retries are timers
         for interface in self.interfaces.values():
             if interface.has_timed_out():
                 self.connection_down(interface.server)
-            elif interface.ping_required():
-                params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
-                self.queue_request('server.version', params, interface)
 
-        now = time.time()
         # nodes
         if len(self.interfaces) + len(self.connecting) < self.num_server:
             self.start_random_interface()
-            if now - self.nodes_retry_time > NODES_RETRY_INTERVAL:
-                self.print_error('network: retrying connections')
-                self.disconnected_servers = set([])
-                self.nodes_retry_time = now
 
         # main interface
         if not self.is_connected():
             if self.auto_connect:
                 if not self.is_connecting():
                     self.switch_to_random_interface()
-            else:
-                if self.default_server in self.disconnected_servers:
-                    if now - self.server_retry_time > SERVER_RETRY_INTERVAL:
-                        self.disconnected_servers.remove(self.default_server)
-                        self.server_retry_time = now
+            elif self.default_server not in self.disconnected_servers:
+                self.switch_to_interface(self.default_server)
+
+    def get_chunk_pool(self):
+        '''Process pool validating chunks in parallel, enabled by setting
+        header_workers.  Returns None if disabled or unavailable, in which
+        case chunks are validated on the network thread.
+
+        The pool forks from a process that already runs threads, and
+        frozen builds cannot start workers without freeze_support, so
+        it is off by default and never used when frozen.'''
+        if self.chunk_pool is None:
+            workers = self.config.get('header_workers', 0)
+            try:
+                if workers < 1 or getattr(sys, 'frozen', False):
+                    self.chunk_pool = False
                 else:
-                    self.switch_to_interface(self.default_server)
+                    import multiprocessing
+                    self.chunk_pool = multiprocessing.Pool(workers)
+                    self.print_error("validating chunks with %d workers" % workers)
+            except BaseException as e:
+                self.print_error("cannot start chunk workers:", e)
+                self.chunk_pool = False
+        return self.chunk_pool or None
+
+    def stop_chunk_pool(self):
+        if self.chunk_pool:
+            self.chunk_pool.terminate()
+        self.chunk_pool = None
+
+    def chunk_interfaces(self, interface, idx):
+        '''Connected interfaces that can serve chunk idx, interface first'''
+        out = [interface]
+        for server, i in self.interfaces.items():
+            if i != interface and self.heights.get(server, 0) >= idx * 2016:
+                out.append(i)
+        return out
 
     def request_chunk(self, interface, data, idx):
         interface.print_error("requesting chunk %d" % idx)
         self.queue_request('blockchain.block.get_chunk', [idx], interface)
-        data['chunk_idx'] = idx
+        self.requested_chunks[idx] = interface
         data['req_time'] = time.time()
 
+    def start_chunk_download(self, interface, data, idx):
+        self.reset_chunk_download()
+        data['chunk_idx'] = idx
+        data['next_chunk'] = idx
+        self.fill_chunk_pipeline(interface, data)
+
+    def reset_chunk_download(self):
+        self.requested_chunks = {}
+        self.chunk_results = {}
+
+    def fill_chunk_pipeline(self, interface, data):
+        '''Keep up to chunk_pipeline chunks requested or awaiting
+        validation, spread over the interfaces that have them.'''
+        # Re-request chunks whose interface went away
+        for idx, i in self.requested_chunks.items():
+            if i not in self.interfaces.values():
+                self.request_chunk(interface, data, idx)
+        last_idx = data['if_height'] / 2016
+        n = data['next_chunk']
+        while (n <= last_idx and len(self.requested_chunks)
+               + len(self.chunk_results) < self.chunk_pipeline):
+            interfaces = self.chunk_interfaces(interface, n)
+            self.request_chunk(interfaces[n % len(interfaces)], data, n)
+            n += 1
+        data['next_chunk'] = n
+
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
-        if self.bc_requests:
-            req_if, data = self.bc_requests[0]
-            req_idx = data.get('chunk_idx')
-            # Ignore unsolicited chunks
-            if req_if == interface and req_idx == response['params'][0]:
-                idx = self.blockchain.connect_chunk(req_idx, response['result'])
-                # If not finished, get the next chunk
-                if idx < 0 or self.get_local_height() >= data['if_height']:
-                    self.bc_requests.popleft()
-                    self.notify('updated')
-                else:
-                    self.request_chunk(interface, data, idx)
+        if not self.bc_requests:
+            return
+        idx = response['params'][0]
+        req_if, data = self.bc_requests[0]
+        if req_if == interface and data.get('fork_chunk') == idx:
+            self.on_fork_chunk(interface, data, response)
+            return
+        # Ignore unsolicited chunks
+        if self.requested_chunks.get(idx) != interface:
+            return
+        self.requested_chunks.pop(idx)
+        if response.get('error'):
+            interface.print_error("chunk error:", response.get('error'))
+            # fill_chunk_pipeline will ask the catch-up interface again
+            self.requested_chunks[idx] = None
+            return
+        hexdata = response['result']
+        # chunks below a checkpoint are only checked for linkage
+        check_pow = not self.blockchain.is_checkpointed(idx)
+        pool = self.get_chunk_pool()
+        if pool:
+            # wake up the loop to commit the chunk once it is checked
+            self.chunk_results[idx] = pool.apply_async(blockchain.check_chunk_job, (hexdata, check_pow),
+                                                       callback=lambda r: self.loop.wakeup())
+        else:
+            self.chunk_results[idx] = blockchain.check_chunk_job(hexdata, check_pow)
+
+    def process_chunks(self, interface, data):
+        '''Commit validated chunks in order and refill the pipeline.
+        Returns False once the download is finished or has failed.'''
+        while True:
+            idx = data['chunk_idx']
+            r = self.chunk_results.get(idx)
+            if r is None or (hasattr(r, 'ready') and not r.ready()):
+                break
+            self.chunk_results.pop(idx)
+            try:
+                result = r.get() if hasattr(r, 'ready') else r
+                if isinstance(result, BaseException):
+                    raise result
+                chunk, hashes = result
+            except BaseException as e:
+                self.print_error('verify_chunk failed', str(e))
+                next_idx = idx - 1
+            else:
+                next_idx = self.blockchain.commit_chunk(idx, chunk, hashes)
+            data['req_time'] = time.time()
+            if next_idx < 0 or self.get_local_height() >= data['if_height']:
+                self.reset_chunk_download()
+                self.notify('updated')
+                return False
+            if next_idx != idx + 1:
+                # Did not connect: restart from the previous chunk
+                self.start_chunk_download(interface, data, next_idx)
+                return True
+            data['chunk_idx'] = next_idx
+            self.notify('updated')
+        self.fill_chunk_pipeline(interface, data)
+        return True
 
     def request_header(self, interface, data, height):
         interface.print_error("requesting header %d" % height)
@@ -708,6 +850,33 @@ class Network(util.DaemonThread):
         if not 'chain' in data:
             data['chain'] = []
 
+    def request_fork_chunk(self, interface, data, idx):
+        '''Fetch the headers below a reorg in one request'''
+        interface.print_error("requesting fork chunk %d" % idx)
+        self.queue_request('blockchain.block.get_chunk', [idx], interface)
+        data['fork_chunk'] = idx
+        data['req_time'] = time.time()
+
+    def on_fork_chunk(self, interface, data, response):
+        if response.get('error'):
+            interface.print_error("chunk error:", response.get('error'))
+            result = False
+        else:
+            result = self.blockchain.connect_fork(data['chain'], data['fork_chunk'], response['result'])
+        if isinstance(result, bool):
+            self.on_header_chain_done(interface, result)
+        else:
+            self.request_fork_chunk(interface, data, result)
+
+    def on_header_chain_done(self, interface, connected):
+        self.bc_requests.popleft()
+        if connected:
+            self.switch_lagging_interface(interface.server)
+            self.notify('updated')
+        else:
+            interface.print_error("header didn't connect, dismissing interface")
+            interface.stop()
+
     def on_get_header(self, interface, response):
         '''Handle receiving a single block header'''
         if self.blockchain.downloading_headers:
@@ -720,13 +889,11 @@ class Network(util.DaemonThread):
                 next_height = self.blockchain.connect_header(data['chain'], response['result'])
                 # If not finished, get the next header
                 if next_height in [True, False]:
-                    self.bc_requests.popleft()
-                    if next_height:
-                        self.switch_lagging_interface(interface.server)
-                        self.notify('updated')
-                    else:
-                        interface.print_error("header didn't connect, dismissing interface")
-                        interface.stop()
+                    self.on_header_chain_done(interface, next_height)
+                elif self.blockchain.get_hash(next_height) is not None:
+                    # We have a different header there: fetch the
+                    # chunk below and find the fork point locally
+                    self.request_fork_chunk(interface, data, next_height / 2016)
                 else:
                     self.request_header(interface, data, next_height)
 
@@ -740,7 +907,7 @@ class Network(util.DaemonThread):
         if if_height <= local_height:
             return False
         elif if_height > local_height + 50:
-            self.request_chunk(interface, data, (local_height + 1) / 2016)
+            self.start_chunk_download(interface, data, (local_height + 1) / 2016)
         else:
             self.request_header(interface, data, if_height)
         return True
@@ -753,6 +920,8 @@ class Network(util.DaemonThread):
             interface, data = self.bc_requests.popleft()
             # If the connection was lost move on
             if not interface in self.interfaces.values():
+                if 'chunk_idx' in data:
+                    self.reset_chunk_download()
                 continue
             req_time = data.get('req_time')
             if not req_time:
@@ -762,34 +931,32 @@ class Network(util.DaemonThread):
                     continue
             elif time.time() - req_time > 70:
                 interface.print_error("blockchain request timed out")
+                self.reset_chunk_download()
                 self.connection_down(interface.server)
                 continue
+            elif 'chunk_idx' in data:
+                if not self.process_chunks(interface, data):
+                    continue
             # Put updated request state back at head of deque
             self.bc_requests.appendleft((interface, data))
             break
 
     def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
+        '''Waits until a socket is ready, a timer is due, another thread
+        sends requests, or JOBS_INTERVAL has passed.'''
         rin = [i for i in self.interfaces.values()]
-        win = [i for i in self.interfaces.values() if i.num_requests()]
-        try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
-        except socket.error as (code, msg):
-            if code == errno.EINTR:
-                return
-            raise
-        assert not xout
+        win = [i for i in rin if i.wants_write()]
+        rout, wout = self.loop.select(rin, win, JOBS_INTERVAL)
         for interface in wout:
             interface.send_requests()
         for interface in rout:
             self.process_responses(interface)
+        self.loop.run_timers()
 
     def run(self):
         self.blockchain.init()
+        self.loop.call_later(NODES_RETRY_INTERVAL, self.retry_nodes)
+        self.loop.call_later(SERVER_RETRY_INTERVAL, self.retry_server)
         while self.is_running():
             self.maintain_sockets()
             self.wait_on_sockets()
@@ -797,9 +964,16 @@ class Network(util.DaemonThread):
             self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
 
+        self.stop_chunk_pool()
+        self.merkle_cache.save(True)
         self.stop_network()
+        self.loop.close()
         self.on_stop()
 
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.loop.wakeup()
+
     def on_header(self, i, header):
         height = header.get('block_height')
         if not height:
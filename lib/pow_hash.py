@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Proof-of-work hashes of the Myriad algorithms.
+
+The algorithm of a header is encoded in its version.  Each algorithm
+has a list of candidate backends (C extensions, then ctypes bindings);
+the first one that loads is used.  Algorithms without a backend are
+reported by unavailable_algos() and their headers are only checked
+for hash linkage.
+'''
+
+import hashlib
+import ctypes
+import ctypes.util
+
+from bitcoin import Hash
+from util import print_error
+
+
+ALGO_SHA256D = 0
+ALGO_SCRYPT = 1
+ALGO_GROESTL = 2
+ALGO_SKEIN = 3
+ALGO_QUBIT = 4
+ALGO_YESCRYPT = 5
+
+ALGO_NAMES = {
+    ALGO_SHA256D: 'sha256d',
+    ALGO_SCRYPT: 'scrypt',
+    ALGO_GROESTL: 'groestl',
+    ALGO_SKEIN: 'skein',
+    ALGO_QUBIT: 'qubit',
+    ALGO_YESCRYPT: 'yescrypt',
+}
+
+BLOCK_VERSION_AUXPOW = 1 << 8
+BLOCK_VERSION_ALGO = 7 << 9
+
+# ~uint256(0) >> 20, the loosest target of any algorithm
+POW_LIMIT = (1 << 236) - 1
+
+
+def get_algo(version):
+    return (version & BLOCK_VERSION_ALGO) >> 9
+
+
+def is_auxpow(version):
+    '''Merge-mined headers carry their proof of work in the parent
+    block, which is not part of the 80-byte header.'''
+    return bool(version & BLOCK_VERSION_AUXPOW)
+
+
+def bits_to_target(bits):
+    bitsN = (bits >> 24) & 0xff
+    bitsBase = bits & 0x7fffff
+    if bits & 0x800000:
+        raise Exception("negative target in bits %08x" % bits)
+    if bitsN <= 3:
+        return bitsBase >> (8 * (3 - bitsN))
+    return bitsBase << (8 * (bitsN - 3))
+
+
+def _sha256(x):
+    return hashlib.sha256(x).digest()
+
+
+def _module_backend(name, func):
+    def load():
+        m = __import__(name)
+        return getattr(m, func)
+    return load
+
+
+def _scrypt_py():
+    import scrypt
+    return lambda h: scrypt.hash(h, h, 1024, 1, 1, 32)
+
+
+def _scrypt_ctypes():
+    path = ctypes.util.find_library('scrypt')
+    if not path:
+        raise ImportError('libscrypt not found')
+    lib = ctypes.CDLL(path)
+    f = lib.libscrypt_scrypt
+    f.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p, ctypes.c_size_t,
+                  ctypes.c_uint64, ctypes.c_uint32, ctypes.c_uint32,
+                  ctypes.c_char_p, ctypes.c_size_t]
+    def scrypt_hash(h):
+        h = str(h)
+        out = ctypes.create_string_buffer(32)
+        if f(h, len(h), h, len(h), 1024, 1, 1, out, 32) != 0:
+            raise Exception('libscrypt failed')
+        return out.raw
+    return scrypt_hash
+
+
+def _skein_py():
+    import skein
+    return lambda h: _sha256(skein.skein512(str(h)).digest())
+
+
+def _groestl_py():
+    import groestl_hash
+    return lambda h: _sha256(groestl_hash.groestl512(str(h)))
+
+
+# algo -> list of (backend name, loader).  Loaders return a function
+# mapping a raw header to its raw (little-endian) PoW hash.
+BACKENDS = {
+    ALGO_SHA256D: [('hashlib', lambda: Hash)],
+    ALGO_SCRYPT: [('ltc_scrypt', _module_backend('ltc_scrypt', 'getPoWHash')),
+                  ('scrypt', _scrypt_py),
+                  ('libscrypt', _scrypt_ctypes)],
+    ALGO_GROESTL: [('groestl_hash', _groestl_py)],
+    ALGO_SKEIN: [('skein', _skein_py)],
+    ALGO_QUBIT: [('qubit_hash', _module_backend('qubit_hash', 'getPoWHash'))],
+    ALGO_YESCRYPT: [('yescrypt', _module_backend('yescrypt', 'getPoWHash'))],
+}
+
+_loaded = {}
+
+
+def register_backend(algo, name, loader):
+    '''Add a backend in front of the existing ones for algo'''
+    BACKENDS.setdefault(algo, []).insert(0, (name, loader))
+    _loaded.pop(algo, None)
+
+
+def get_pow_hash(algo):
+    '''Fastest available PoW hash function for algo, or None'''
+    if algo not in _loaded:
+        _loaded[algo] = None
+        for name, loader in BACKENDS.get(algo, []):
+            try:
+                _loaded[algo] = loader()
+            except Exception:
+                continue
+            print_error("[pow_hash] %s: using %s" % (ALGO_NAMES.get(algo, algo), name))
+            break
+        else:
+            print_error("[pow_hash] %s: no backend, not checking proof of work"
+                        % ALGO_NAMES.get(algo, algo))
+    return _loaded[algo]
+
+
+def unavailable_algos():
+    return [ALGO_NAMES[a] for a in sorted(ALGO_NAMES) if get_pow_hash(a) is None]
+
+
+def check_pow(raw_header, version, bits, sha256d_hash=None):
+    '''Checks one raw header against the target encoded in its bits.
+    Returns False if the proof of work could not be checked.'''
+    target = bits_to_target(bits)
+    if target > POW_LIMIT:
+        raise Exception("target above pow limit: bits %08x" % bits)
+    if is_auxpow(version):
+        return False
+    algo = get_algo(version)
+    if algo == ALGO_SHA256D and sha256d_hash is not None:
+        h = sha256d_hash
+    else:
+        f = get_pow_hash(algo)
+        if f is None:
+            return False
+        h = f(raw_header)
+    if int(h[::-1].encode('hex'), 16) > target:
+        raise Exception("insufficient proof of work (%s): %s vs target %064x"
+                        % (ALGO_NAMES.get(algo, algo), h[::-1].encode('hex'), target))
+    return True
+
+
+def check_pow_batch(data, versions, bits, hashes=None):
+    '''Checks the proof of work of a buffer of raw headers.  Headers are
+    grouped by algorithm so each backend is looked up once per batch;
+    hashes, if given, are the raw sha256d hashes already computed for
+    linkage.  Returns the number of headers whose PoW was checked.'''
+    groups = {}
+    for i, version in enumerate(versions):
+        if is_auxpow(version):
+            continue
+        groups.setdefault(get_algo(version), []).append(i)
+    checked = 0
+    for algo, indexes in groups.items():
+        if algo == ALGO_SHA256D and hashes is not None:
+            pow_hashes = [hashes[i] for i in indexes]
+        else:
+            f = get_pow_hash(algo)
+            if f is None:
+                continue
+            pow_hashes = [f(buffer(data, i * 80, 80)) for i in indexes]
+        for i, h in zip(indexes, pow_hashes):
+            target = bits_to_target(bits[i])
+            if target > POW_LIMIT or int(h[::-1].encode('hex'), 16) > target:
+                raise Exception("insufficient proof of work (%s) at offset %d"
+                                % (ALGO_NAMES.get(algo, algo), i))
+        checked += len(indexes)
+    return checked
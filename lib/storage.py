@@ -32,6 +32,7 @@ import json
 import copy
 import re
 import stat
+import sqlite3
 
 from i18n import _
 from util import NotEnoughFunds, PrintError, profiler
@@ -46,6 +47,21 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 13     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+SQLITE_MAGIC = 'SQLite format 3\x00'
+
+# Wallet sections stored one row per entry by the sqlite engine, so
+# that a write only touches the entries that changed.  Other keys are
+# stored as json in the kv table.
+SQLITE_TABLES = ['transactions', 'txi', 'txo', 'addr_history', 'verified_tx3']
+
+# Tables of hex values kept out of self.data, and accessed by entry.
+# The sqlite engine reads their rows on demand; the json engines hold
+# them in memory as raw bytes.
+LAZY_TABLES = ['transactions']
+
+# the json snapshot is rewritten once the journal outgrows it
+JOURNAL_MIN_COMPACT = 1 << 20
+
 
 
 def multisig_type(wallet_type):
@@ -59,10 +75,21 @@ def multisig_type(wallet_type):
 
 class WalletStorage(PrintError):
 
-    def __init__(self, path):
+    def __init__(self, path, engine=None):
         self.lock = threading.RLock()
         self.data = {}
+        # name -> {key: raw bytes} of the lazy tables.  With the sqlite
+        # engine, only the entries not written yet, None if deleted.
+        self.tables = {}
         self.path = path
+        self.engine = engine
+        self.db = None
+        # key -> set of changed entries of a table, or None if the
+        # whole key must be rewritten
+        self.dirty = {}
+        self.journal_path = path + '.journal' if path else None
+        self.journal_size = 0
+        self.snapshot_size = 0
         self.file_exists = False
         self.modified = False
         self.print_error("wallet path", self.path)
@@ -83,6 +110,10 @@ class WalletStorage(PrintError):
             return
         if not data:
             return
+        if data.startswith(SQLITE_MAGIC):
+            self.read_sqlite()
+            self.file_exists = True
+            return
         try:
             self.data = json.loads(data)
         except:
@@ -106,10 +137,86 @@ class WalletStorage(PrintError):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+        self.snapshot_size = len(data)
+        self.replay_journal()
+        self.load_tables()
         self.file_exists = True
 
+    def replay_journal(self):
+        '''Applies the changes journaled since the last snapshot.  Each
+        line holds the changes of one write(); a torn last line is from
+        an interrupted write and is ignored.'''
+        try:
+            with open(self.journal_path, "r") as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return
+        n = 0
+        size = 0
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            size += len(line) + 1
+            for key, change in record.items():
+                if 'e' in change:
+                    d = self.data.setdefault(key, {})
+                    for k, v in change['e'].items():
+                        if v is None:
+                            d.pop(k, None)
+                        else:
+                            d[k] = v
+                elif change['v'] is None:
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = change['v']
+            n += 1
+        if size < os.path.getsize(self.journal_path):
+            # drop the torn record so that later records follow a newline
+            with open(self.journal_path, "r+") as f:
+                f.truncate(size)
+        self.journal_size = size
+        self.print_error("replayed %d journal records" % n)
+
+    def load_tables(self):
+        '''Moves the lazy tables read from json out of self.data'''
+        for name in LAZY_TABLES:
+            d = self.data.pop(name, None)
+            if type(d) is dict:
+                self.tables[name] = dict((k, v.decode('hex')) for k, v in d.items())
+
+    def append_journal(self):
+        '''Appends the changes since the last write to the journal, as a
+        single line, and syncs it.'''
+        record = {}
+        for key, changed in self.dirty.items():
+            value = self.data.get(key)
+            if key in LAZY_TABLES:
+                record[key] = {'e': dict((k, self.read_entry(key, k)) for k in changed)}
+            elif changed is None:
+                record[key] = {'v': value}
+            else:
+                record[key] = {'e': dict((k, value.get(k)) for k in changed)}
+        line = json.dumps(record, sort_keys=True) + '\n'
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     stat.S_IREAD | stat.S_IWRITE)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.journal_size += len(line)
+        self.modified = False
+        self.dirty = {}
+
     def get(self, key, default=None):
         with self.lock:
+            if key in LAZY_TABLES:
+                keys = self.entry_keys(key)
+                if not keys:
+                    return default
+                return dict((k, self.read_entry(key, k)) for k in keys)
             v = self.data.get(key)
             if v is None:
                 v = default
@@ -125,28 +232,162 @@ class WalletStorage(PrintError):
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
+            if key in LAZY_TABLES:
+                value = value or {}
+                entries = dict((k, None) for k in self.entry_keys(key) if k not in value)
+                entries.update(value)
+                self.put_entries(key, entries)
+                return
+            old = self.data.get(key)
             if value is not None:
-                if self.data.get(key) != value:
+                if old != value:
                     self.modified = True
+                    self.set_dirty(key, old, value)
                     self.data[key] = copy.deepcopy(value)
             elif key in self.data:
                 self.modified = True
+                self.set_dirty(key, old, None)
                 self.data.pop(key)
 
+    def get_entry(self, key, subkey, default=None):
+        '''Entry of a dict value, without copying the whole dict'''
+        with self.lock:
+            if key in LAZY_TABLES:
+                v = self.read_entry(key, subkey)
+            else:
+                v = copy.deepcopy(self.data.get(key, {}).get(subkey))
+            return default if v is None else v
+
+    def read_entry(self, name, k):
+        table = self.tables.get(name, {})
+        if k in table:
+            v = table[k]
+        elif self.db is not None:
+            row = self.db.execute('SELECT value FROM %s WHERE key=?' % name, (k,)).fetchone()
+            v = row[0] if row else None
+        else:
+            v = None
+        return None if v is None else str(v).encode('hex')
+
+    def entry_keys(self, key):
+        with self.lock:
+            if key not in LAZY_TABLES:
+                return self.data.get(key, {}).keys()
+            keys = set()
+            if self.db is not None:
+                keys.update(k.decode('utf8') for k, in self.db.execute('SELECT key FROM %s' % key))
+            for k, v in self.tables.get(key, {}).items():
+                if v is None:
+                    keys.discard(k)
+                else:
+                    keys.add(k)
+            return list(keys)
+
+    def put_entries(self, key, entries):
+        '''Updates entries of a dict value in place; None removes an
+        entry.  Only the given entries are compared and marked dirty.'''
+        with self.lock:
+            if key in LAZY_TABLES:
+                self.put_table_entries(key, entries)
+                return
+            d = self.data.setdefault(key, {})
+            for k, v in entries.items():
+                if d.get(k) == v:
+                    continue
+                if v is None:
+                    d.pop(k)
+                else:
+                    d[k] = copy.deepcopy(v)
+                self.modified = True
+                changed = self.dirty.setdefault(key, set())
+                if changed is not None:
+                    changed.add(k)
+
+    def put_table_entries(self, name, entries):
+        table = self.tables.setdefault(name, {})
+        changed = self.dirty.setdefault(name, set())
+        for k, v in entries.items():
+            raw = None if v is None else v.decode('hex')
+            if self.db is None:
+                # the table holds all the entries
+                if table.get(k) == raw:
+                    continue
+                if raw is None:
+                    table.pop(k)
+                else:
+                    table[k] = raw
+            else:
+                # pending until the next write
+                table[k] = raw
+            self.modified = True
+            changed.add(k)
+
+    def set_dirty(self, key, old, new):
+        if key in SQLITE_TABLES and type(old) is dict and type(new) is dict:
+            if key in self.dirty and self.dirty[key] is None:
+                return
+            changed = self.dirty.setdefault(key, set())
+            changed.update(k for k, v in new.items() if old.get(k) != v)
+            changed.update(k for k in old if k not in new)
+        else:
+            self.dirty[key] = None
+
     def write(self):
         # this ensures that previous versions of electrum won't open the wallet
         self.put('seed_version', FINAL_SEED_VERSION)
         with self.lock:
+            if self.modified and 'revision' in self.data:
+                self.put('revision', self.get_revision() + 1)
             self._write()
         self.file_exists = True
 
+    def get_revision(self):
+        '''Number of writes that changed the wallet, counted since the
+        first call to next_revision().  Lets data cached in the wallet
+        detect later writes.'''
+        return self.data.get('revision', 0)
+
+    def next_revision(self):
+        '''Revision of the wallet after the next write'''
+        with self.lock:
+            if 'revision' not in self.data:
+                self.put('revision', 0)
+            return self.get_revision() + 1
+
     def _write(self):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True)
+        if self.db is None and self.engine == 'sqlite' and not os.path.exists(self.path):
+            self.create_sqlite()
+            return
+        if self.db is not None:
+            self.write_sqlite()
+            return
+        if self.engine == 'journal' and os.path.exists(self.path):
+            self.append_journal()
+            if self.journal_size <= max(self.snapshot_size, JOURNAL_MIN_COMPACT):
+                return
+        self.write_snapshot()
+
+    def compact(self):
+        '''Folds the journal into the json snapshot'''
+        with self.lock:
+            if self.db is not None or not (self.journal_size or self.modified):
+                return
+            if threading.currentThread().isDaemon():
+                self.print_error('warning: daemon thread cannot write wallet')
+                return
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        data = dict(self.data)
+        for name, table in self.tables.items():
+            if table:
+                data[name] = dict((k, v.encode('hex')) for k, v in table.items())
+        s = json.dumps(data, indent=4, sort_keys=True)
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w") as f:
             f.write(s)
@@ -163,6 +404,110 @@ class WalletStorage(PrintError):
         os.chmod(self.path, mode)
         self.print_error("saved", self.path)
         self.modified = False
+        self.dirty = {}
+        self.snapshot_size = len(s)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_size = 0
+
+    def is_sqlite(self):
+        return self.db is not None
+
+    def connect_sqlite(self, path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.text_factory = str
+        db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)')
+        for name in SQLITE_TABLES:
+            db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB)' % name)
+        db.commit()
+        return db
+
+    def read_sqlite(self):
+        self.db = self.connect_sqlite(self.path)
+        self.data = {}
+        for key, value in self.db.execute('SELECT key, value FROM kv'):
+            self.data[key.decode('utf8')] = json.loads(value)
+        for name in SQLITE_TABLES:
+            if name in LAZY_TABLES:
+                continue
+            rows = self.db.execute('SELECT key, value FROM %s' % name).fetchall()
+            if rows:
+                self.data[unicode(name)] = dict((k.decode('utf8'), json.loads(v))
+                                                for k, v in rows)
+
+    def write_sqlite(self):
+        '''Writes the keys changed since the last write in a single
+        transaction.  Table sections only write their changed entries.'''
+        with self.db:
+            for key, changed in self.dirty.items():
+                self.write_sqlite_key(key, changed)
+        self.print_error("saved", self.path, len(self.dirty), "keys")
+        self.modified = False
+        self.dirty = {}
+        self.tables = {}
+
+    def write_sqlite_key(self, key, changed):
+        if key in LAZY_TABLES:
+            table = self.tables.get(key, {})
+            for k in (table.keys() if changed is None else changed):
+                v = table.get(k)
+                if v is None:
+                    self.db.execute('DELETE FROM %s WHERE key=?' % key, (k,))
+                else:
+                    self.db.execute('INSERT OR REPLACE INTO %s VALUES (?,?)' % key,
+                                    (k, sqlite3.Binary(v)))
+            return
+        value = self.data.get(key)
+        if key not in SQLITE_TABLES or (value is not None and type(value) is not dict):
+            if key in SQLITE_TABLES:
+                self.db.execute('DELETE FROM %s' % key)
+            if value is None:
+                self.db.execute('DELETE FROM kv WHERE key=?', (key,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO kv VALUES (?,?)', (key, json.dumps(value)))
+            return
+        self.db.execute('DELETE FROM kv WHERE key=?', (key,))
+        value = value or {}
+        if changed is None:
+            self.db.execute('DELETE FROM %s' % key)
+            changed = value.keys()
+        for k in changed:
+            v = value.get(k)
+            if v is None:
+                self.db.execute('DELETE FROM %s WHERE key=?' % key, (k,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO %s VALUES (?,?)' % key,
+                                (k, json.dumps(v)))
+
+    def create_sqlite(self):
+        '''Writes all the data to a new sqlite file, atomically replacing
+        the wallet file.  Used for new wallets and for the migration of
+        json wallets.'''
+        mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        os.close(os.open(temp_path, os.O_CREAT | os.O_WRONLY, stat.S_IREAD | stat.S_IWRITE))
+        db = self.connect_sqlite(temp_path)
+        self.db = db
+        try:
+            with db:
+                for key in self.data.keys() + self.tables.keys():
+                    self.write_sqlite_key(key, None)
+        finally:
+            db.close()
+            self.db = None
+        try:
+            os.rename(temp_path, self.path)
+        except:
+            os.remove(self.path)
+            os.rename(temp_path, self.path)
+        os.chmod(self.path, mode)
+        self.db = self.connect_sqlite(self.path)
+        self.print_error("saved", self.path, "(sqlite)")
+        self.modified = False
+        self.dirty = {}
+        self.tables = {}
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -179,11 +524,13 @@ class WalletStorage(PrintError):
             assert len(d) == 2
             storage1 = WalletStorage(storage.path + '.deterministic')
             storage1.data = copy.deepcopy(storage.data)
+            storage1.tables = copy.deepcopy(storage.tables)
             storage1.put('accounts', {'0': d['0']})
             storage1.upgrade()
             storage1.write()
             storage2 = WalletStorage(storage.path + '.imported')
             storage2.data = copy.deepcopy(storage.data)
+            storage2.tables = copy.deepcopy(storage.tables)
             storage2.put('accounts', {'/x': d['/x']})
             storage2.put('seed', None)
             storage2.put('seed_version', None)
@@ -203,6 +550,7 @@ class WalletStorage(PrintError):
                 new_path = storage.path + '.' + k
                 storage2 = WalletStorage(new_path)
                 storage2.data = copy.deepcopy(storage.data)
+                storage2.tables = copy.deepcopy(storage.tables)
                 # save account, derivation and xpub at index 0
                 storage2.put('accounts', {'0': x})
                 storage2.put('master_public_keys', {"x/0'": xpub})
@@ -215,7 +563,14 @@ class WalletStorage(PrintError):
         return result
 
     def requires_upgrade(self):
-        return self.file_exists and self.get_seed_version() != FINAL_SEED_VERSION
+        if not self.file_exists:
+            return False
+        return self.get_seed_version() != FINAL_SEED_VERSION
+
+    def requires_engine_conversion(self):
+        # 'wallet_engine' only applies to new wallets; existing json
+        # wallets are converted when the user asks for it
+        return self.engine == 'sqlite' and self.db is None
 
     def upgrade(self):
         self.convert_imported()
@@ -224,6 +579,16 @@ class WalletStorage(PrintError):
         self.convert_pubkeys()
         self.write()
 
+    def convert_engine(self):
+        if not self.requires_engine_conversion():
+            return
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot convert wallet')
+            return
+        with self.lock:
+            self.print_error('converting wallet to sqlite')
+            self.create_sqlite()
+
     def convert_pubkeys(self):
         # version 12 had a bug in pubkey ordering
         # it is fixed by forcing pubkey regeneration
@@ -7,7 +7,8 @@ from lib.bitcoin import (
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_valid, is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push)
+    var_int, op_push, available_ec_backends, set_ec_backend, load_ec_backend,
+    ECDSA_Backend, CKD_pub, CKD_pub_batch, deserialize_xkey)
 
 try:
     import ecdsa
@@ -18,8 +19,13 @@ except ImportError:
 class Test_bitcoin(unittest.TestCase):
 
     def test_crypto(self):
-        for message in ["Chancellor on brink of second bailout for banks", chr(255)*512]:
-            self._do_test_crypto(message)
+        try:
+            for name in available_ec_backends():
+                set_ec_backend(name)
+                for message in ["Chancellor on brink of second bailout for banks", chr(255)*512]:
+                    self._do_test_crypto(message)
+        finally:
+            set_ec_backend()
 
     def _do_test_crypto(self, message):
         G = generator_secp256k1
@@ -111,6 +117,19 @@ class Test_bitcoin(unittest.TestCase):
         result = Hash(payload)
         self.assertEqual(expected, result)
 
+    def test_CKD_pub_batch(self):
+        xpub = "xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8"
+        depth, fingerprint, child_number, c, cK = deserialize_xkey(xpub)
+        sequence = [0, 1, 2, 19, 20, 1000]
+        try:
+            for name in available_ec_backends():
+                set_ec_backend(name)
+                expected = [CKD_pub(cK, c, n)[0] for n in sequence]
+                self.assertEqual(expected, CKD_pub_batch(cK, c, sequence))
+        finally:
+            set_ec_backend()
+        self.assertEqual([], CKD_pub_batch(cK, c, []))
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         # Taken from test vectors in https://en.bitcoin.it/wiki/BIP_0032_TestVectors
@@ -150,6 +169,38 @@ class Test_bitcoin(unittest.TestCase):
         self.assertEqual(op_push(0x12345678), '4e78563412')
 
 
+class Test_ec_backends(unittest.TestCase):
+
+    def test_default_backend(self):
+        import lib.bitcoin
+        self.assertEqual(ECDSA_Backend, type(load_ec_backend()))
+        self.assertEqual('ecdsa', set_ec_backend().name)
+        self.assertEqual(ECDSA_Backend, type(lib.bitcoin.ec_backend))
+        self.assertRaises(Exception, load_ec_backend, 'openssl')
+
+    def test_backends_agree(self):
+        import hashlib
+        reference = ECDSA_Backend()
+        for name in available_ec_backends():
+            backend = load_ec_backend(name)
+            for i in range(1, 4):
+                secret = hashlib.sha256(str(i)).digest()
+                msg_hash = hashlib.sha256('message %d' % i).digest()
+                pubkey = backend.pubkey_from_secret(secret, True)
+                self.assertEqual(reference.pubkey_from_secret(secret, True), pubkey)
+                self.assertEqual(reference.pubkey_from_secret(secret, False),
+                                 backend.pubkey_from_secret(secret, False))
+                sig = backend.sign(secret, msg_hash)
+                self.assertEqual(reference.sign(secret, msg_hash), sig)
+                self.assertTrue(backend.verify(pubkey, msg_hash, sig))
+                self.assertFalse(backend.verify(pubkey, hashlib.sha256('other').digest(), sig))
+                recovered = [backend.recover(msg_hash, sig, recid, True) for recid in range(4)]
+                self.assertTrue(pubkey in recovered)
+                self.assertEqual(reference.pubkey_tweak_add(pubkey, [msg_hash, secret]),
+                                 backend.pubkey_tweak_add(pubkey, [msg_hash, secret]))
+                self.assertEqual(reference.ecdh(pubkey, msg_hash), backend.ecdh(pubkey, msg_hash))
+
+
 class Test_keyImport(unittest.TestCase):
     """ The keys used in this class are TEST keys from
         https://en.bitcoin.it/wiki/BIP_0032_TestVectors"""
@@ -0,0 +1,438 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import BaseHTTPServer
+
+from lib import bitcoin, blockchain, pow_hash
+from lib.bitcoin import Hash, hash_encode
+
+
+def make_headers(n, start=0):
+    '''n distinct raw headers, not linked'''
+    return ''.join(('%08x' % (start + i)).decode('hex') + '\1' * 76 for i in range(n))
+
+
+def steady_columns(n, bits=0x1e0fffff, spacing=30):
+    '''Columns of n headers mined in turn by each algorithm, on time'''
+    versions = [2 | ((i % blockchain.NUM_ALGOS) << 9) for i in range(n)]
+    timestamps = [1400000000 + spacing * i for i in range(n)]
+    return versions, timestamps, [bits] * n
+
+
+class TestRetarget(unittest.TestCase):
+
+    def test_target_to_bits(self):
+        for bits in [0x1d00ffff, 0x1b0404cb, 0x1e0fffff, 0x1c7fffff, 0x03123456]:
+            target = pow_hash.bits_to_target(bits)
+            self.assertEqual(blockchain.target_to_bits(target), bits)
+        # the sign bit is never set
+        self.assertEqual(blockchain.target_to_bits(0x80 << 200), 0x1b008000)
+
+    def test_get_next_bits(self):
+        target = pow_hash.bits_to_target(0x1c0fffff)
+        # on time, in turn
+        self.assertEqual(blockchain.get_next_bits(100, 0x1c0fffff, 95, 1500), 0x1c0fffff)
+        # fast blocks: damped, then limited to 2% harder
+        self.assertEqual(blockchain.get_next_bits(100, 0x1c0fffff, 95, 0),
+                         blockchain.target_to_bits(target * 1470 / 1500))
+        # slow blocks: limited to 4% easier
+        self.assertEqual(blockchain.get_next_bits(100, 0x1c0fffff, 95, 10000),
+                         blockchain.target_to_bits(target * 1560 / 1500))
+        # an algorithm mining twice in a row gets 4% harder
+        self.assertEqual(blockchain.get_next_bits(100, 0x1c0fffff, 99, 1500),
+                         blockchain.target_to_bits(target * 100 / 104 * 100 / 104 * 100 / 104 * 100 / 104))
+        # one missing its turn gets easier
+        self.assertEqual(blockchain.get_next_bits(100, 0x1c0fffff, 94, 1500),
+                         blockchain.target_to_bits(target * 104 / 100))
+        # twice the spacing after the fork
+        self.assertEqual(blockchain.get_next_bits(1764000, 0x1c0fffff, 1763995, 3000), 0x1c0fffff)
+        # never above the limit
+        self.assertEqual(blockchain.get_next_bits(100, 0x1e0fffff, 90, 1500),
+                         blockchain.target_to_bits(pow_hash.POW_LIMIT))
+
+    def test_check_bits(self):
+        versions, timestamps, bits = steady_columns(200)
+        # headers whose inputs precede the columns are skipped
+        self.assertEqual(blockchain.check_bits(versions, timestamps, bits, 1000), 200 - 61)
+        self.assertEqual(blockchain.check_bits(versions, timestamps, bits, 1000, first=150), 50)
+        bits[120] = 0x1e0ffffe
+        self.assertRaises(Exception, blockchain.check_bits, versions, timestamps, bits, 1000)
+        self.assertEqual(blockchain.check_bits(versions, timestamps, bits, 1000, first=130), 70)
+
+    def test_check_bits_follows_algorithms(self):
+        versions, timestamps, bits = steady_columns(100)
+        # the next header repeats the algorithm of the last one
+        versions.append(versions[-1])
+        timestamps.append(timestamps[-1] + 30)
+        bits.append(0x1e0fffff)
+        self.assertRaises(Exception, blockchain.check_bits, versions, timestamps, bits, 1000)
+        bits[-1] = blockchain.get_next_bits(1100, 0x1e0fffff, 1099, 1500)
+        self.assertEqual(blockchain.check_bits(versions, timestamps, bits, 1000, first=100), 1)
+
+
+class TestHeaderStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'headers')
+        open(self.path, 'wb').close()
+        self.store = blockchain.HeaderStore(self.path, cache_size=4, hash_cache_size=8)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_read_write(self):
+        data = make_headers(10)
+        self.store.write(0, data)
+        self.assertEqual(self.store.height(), 9)
+        self.assertEqual(str(self.store.read_raw(3)), data[240:320])
+        self.assertEqual(self.store.hash(3), hash_encode(Hash(data[240:320])))
+        self.assertEqual(self.store.read_header(3)['nonce'], 0x01010101)
+        self.assertIsNone(self.store.read_raw(10))
+        self.assertIsNone(self.store.hash(-1))
+
+    def test_missing_headers(self):
+        self.store.write(5, make_headers(1))
+        self.assertIsNone(self.store.read_raw(2))
+        self.assertIsNone(self.store.hash(2))
+        self.assertIsNotNone(self.store.read_raw(5))
+
+    def test_hash_cache_is_bounded(self):
+        self.store.write(0, make_headers(20))
+        for i in range(20):
+            self.store.hash(i)
+        self.assertEqual(len(self.store.hashes), 8)
+        self.assertEqual(len(self.store.headers), 0)
+        for i in range(20):
+            self.store.read_header(i)
+        self.assertEqual(len(self.store.headers), 4)
+
+    def test_prime_keeps_recent_hashes(self):
+        self.store.write(0, make_headers(20))
+        self.store.prime(0, ['%064x' % i for i in range(20)])
+        self.assertEqual(sorted(self.store.hashes.keys()), range(12, 20))
+        self.assertEqual(self.store.hash(19), '%064x' % 19)
+
+    def test_write_invalidates(self):
+        self.store.write(0, make_headers(10))
+        old = [self.store.hash(i) for i in range(10)]
+        self.store.read_header(8)
+        data = make_headers(3, start=100)
+        self.store.write(7, data)
+        self.assertEqual([self.store.hash(i) for i in range(7)], old[:7])
+        self.assertEqual(self.store.hash(7), hash_encode(Hash(data[:80])))
+        self.assertEqual(self.store.read_header(8)['version'], 0x65000000)
+        self.store.truncate(5)
+        self.assertEqual(self.store.height(), 4)
+        self.assertIsNone(self.store.hash(6))
+
+
+def extend_chain(base, n, spacing=30):
+    '''Raw headers of n blocks following the raw headers in base, mined
+    in turn by each algorithm but sha256d, whose proof of work is checked
+    on the linkage hashes, with the bits the retarget requires'''
+    span = blockchain.NUM_ALGOS * blockchain.AVERAGING_INTERVAL
+    columns = blockchain.unpack_headers(base) if base else [[]] * blockchain.HEADER_FIELDS
+    timestamps, bits = list(columns[3]), list(columns[4])
+    prev = Hash(base[-80:]) if base else '\0' * 32
+    def mtp(j):
+        window = sorted(timestamps[max(0, j - 10):j + 1])
+        return window[len(window) / 2]
+    out = []
+    for i in range(len(timestamps), len(timestamps) + n):
+        version = 2 | ((1 + i % blockchain.NUM_ALGOS) << 9)
+        timestamps.append(timestamps[-1] + spacing if timestamps else 1400000000)
+        bits.append(0x1e0fffff)
+        if i > span:
+            prev_algo = i - blockchain.NUM_ALGOS
+            bits[i] = blockchain.get_next_bits(i, bits[prev_algo], prev_algo, mtp(i - 1) - mtp(i - 1 - span))
+        header = struct.pack('<I32s32sIII', version, prev, '\0' * 32, timestamps[i], bits[i], i)
+        prev = Hash(header)
+        out.append(header)
+    return ''.join(out)
+
+
+def make_chain(n):
+    return extend_chain('', n)
+
+
+def header_dicts(data, height):
+    out = []
+    for i in range(len(data) / 80):
+        h = blockchain.deserialize_header(data[i * 80:(i + 1) * 80])
+        h['block_height'] = height + i
+        out.append(h)
+    return out
+
+
+def chain_work(data):
+    return sum(blockchain.target_work(pow_hash.bits_to_target(b))
+               for b in blockchain.unpack_headers(data)[4])
+
+
+def relink(data):
+    '''Point the prev hash of each header to the one before it'''
+    out = [data[:80]]
+    for i in range(1, len(data) / 80):
+        header = data[i * 80:(i + 1) * 80]
+        out.append(header[:4] + Hash(out[-1]) + header[36:])
+    return ''.join(out)
+
+
+class Config(dict):
+
+    def __init__(self, path, **kwargs):
+        dict.__init__(self, kwargs)
+        self.path = path
+
+
+class HeadersHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        data = self.server.data
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBlockchain(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.chain = make_chain(3 * 2016)
+
+    def setUp(self):
+        self.dirs = []
+        self.backends = dict((k, list(v)) for k, v in pow_hash.BACKENDS.items())
+        for algo in pow_hash.ALGO_NAMES:
+            if algo != pow_hash.ALGO_SHA256D:
+                pow_hash.BACKENDS[algo] = [('test', lambda: lambda h: '\0' * 32)]
+        pow_hash._loaded.clear()
+        self.headers_url = bitcoin.HEADERS_URL
+
+    def tearDown(self):
+        pow_hash.BACKENDS.clear()
+        pow_hash.BACKENDS.update(self.backends)
+        pow_hash._loaded.clear()
+        bitcoin.HEADERS_URL = self.headers_url
+        for d in self.dirs:
+            shutil.rmtree(d)
+
+    def make_blockchain(self, checkpoints=None, **config):
+        d = tempfile.mkdtemp()
+        self.dirs.append(d)
+        bc = blockchain.Blockchain(Config(d, **config), None)
+        if checkpoints is not None:
+            bc.checkpoints = dict((height, (_hash, int(work, 16))) for height, _hash, work in checkpoints)
+        return bc
+
+    def wait_for_download(self, bc):
+        for i in range(100):
+            if not bc.downloading_headers:
+                return
+            time.sleep(0.1)
+        self.fail("download did not finish")
+
+    def chunk(self, idx):
+        return self.chain[idx * 2016 * 80:(idx + 1) * 2016 * 80]
+
+    def test_check_chunk_job(self):
+        chunk = self.chunk(0)
+        bad = chunk[:80] + chunk[160:240]
+        self.assertEqual(blockchain.check_chunk_job(chunk.encode('hex'), False)[0], chunk)
+        self.assertIsInstance(blockchain.check_chunk_job(bad.encode('hex'), False), BaseException)
+        # the pool calls back on failures too
+        import multiprocessing
+        pool = multiprocessing.Pool(1)
+        try:
+            results = []
+            done = threading.Event()
+            def callback(r):
+                results.append(r)
+                if len(results) == 2:
+                    done.set()
+            jobs = [pool.apply_async(blockchain.check_chunk_job, (data.encode('hex'), False),
+                                     callback=callback)
+                    for data in [chunk, bad]]
+            done.wait(10)
+            self.assertTrue(done.is_set())
+            self.assertEqual(jobs[0].get()[0], chunk)
+            self.assertIsInstance(jobs[1].get(), BaseException)
+        finally:
+            pool.terminate()
+
+    def test_sync(self):
+        bc = self.make_blockchain(checkpoints=[])
+        bc.init_headers_file()
+        for idx in range(3):
+            self.assertEqual(bc.connect_chunk(idx, self.chunk(idx).encode('hex')), idx + 1)
+        self.assertEqual(bc.height(), 3 * 2016 - 1)
+        self.assertEqual(bc.get_hash(100), hash_encode(Hash(self.chain[8000:8080])))
+        # wrong bits are only reported, the retarget rules being incomplete
+        bc.truncate(2016)
+        data = bytearray(self.chunk(1))
+        data[1000 * 80 + 72] ^= 1
+        data = relink(str(data))
+        self.assertTrue(bc.verify_bits(2016, self.chunk(1)))
+        self.assertFalse(bc.verify_bits(2016, data))
+        self.assertEqual(bc.connect_chunk(1, data.encode('hex')), 2)
+        self.assertEqual(bc.height(), 2 * 2016 - 1)
+
+    def test_download_headers(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), HeadersHandler)
+        server.data = self.chain[:100 * 80]
+        t = threading.Thread(target=server.handle_request)
+        t.daemon = True
+        t.start()
+        bitcoin.HEADERS_URL = 'http://127.0.0.1:%d/blockchain_headers' % server.server_port
+        try:
+            bc = self.make_blockchain(checkpoints=[])
+            bc.init()
+            self.wait_for_download(bc)
+        finally:
+            server.server_close()
+        self.assertEqual(bc.height(), 99)
+        self.assertEqual(bc.get_hash(99), hash_encode(Hash(self.chain[99 * 80:100 * 80])))
+
+    def test_download_failure(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), HeadersHandler)
+        bitcoin.HEADERS_URL = 'http://127.0.0.1:%d/blockchain_headers' % server.server_port
+        server.server_close()
+        bc = self.make_blockchain(checkpoints=[])
+        bc.init()
+        self.wait_for_download(bc)
+        self.assertTrue(os.path.exists(bc.path()))
+        self.assertEqual(bc.height(), -1)
+
+    def test_headers_from_checkpoint(self):
+        full = self.make_blockchain(checkpoints=[])
+        full.init_headers_file()
+        for idx in range(2):
+            full.connect_chunk(idx, self.chunk(idx).encode('hex'))
+        checkpoints = full.get_checkpoints()
+        self.assertEqual([c[0] for c in checkpoints], [2015, 4031])
+        bc = self.make_blockchain(checkpoints=checkpoints, headers_from_checkpoint=True)
+        bc.init()
+        self.assertFalse(bc.downloading_headers)
+        self.assertEqual(bc.height(), 4031)
+        self.assertIsNone(bc.read_header(100))
+        self.assertEqual(bc.get_hash(4031), checkpoints[-1][1])
+        # sparse files keep the shipped checkpoints
+        self.assertEqual(bc.get_checkpoints(), checkpoints)
+        # the first chunk after the checkpoint connects
+        self.assertEqual(bc.connect_chunk(2, self.chunk(2).encode('hex')), 3)
+        self.assertEqual(bc.get_chainwork(), full.get_chainwork(4031) + bc.chainwork.headers_work(4032, 2016))
+        # a chunk below the checkpoint is filled in for verification
+        data = bytearray(self.chunk(0))
+        data[80 * 100 + 76] ^= 1
+        self.assertRaises(Exception, bc.fill_chunk, 0, str(data).encode('hex'))
+        self.assertIsNone(bc.read_header(100))
+        bc.fill_chunk(0, self.chunk(0).encode('hex'))
+        self.assertEqual(bc.read_header(100), full.read_header(100))
+        self.assertIsNone(bc.read_header(2016))
+        self.assertEqual(bc.height(), 3 * 2016 - 1)
+        self.assertEqual(bc.get_checkpoints()[:2], checkpoints)
+
+    def test_checkpoints_file(self):
+        self.assertEqual(blockchain.load_checkpoints(), {})
+        full = self.make_blockchain(checkpoints=[])
+        full.init_headers_file()
+        for idx in range(2):
+            full.connect_chunk(idx, self.chunk(idx).encode('hex'))
+        # as written by scripts/checkpoints
+        path = os.path.join(self.dirs[0], 'checkpoints.json')
+        with open(path, 'w') as f:
+            f.write(json.dumps(full.get_checkpoints(), indent=0))
+        checkpoints = blockchain.load_checkpoints(path)
+        self.assertEqual(sorted(checkpoints), [2015, 4031])
+        self.assertEqual(checkpoints[4031], (full.get_hash(4031), full.get_chainwork(4031)))
+        bc = self.make_blockchain(headers_from_checkpoint=True)
+        bc.checkpoints = checkpoints
+        bc.init()
+        self.assertFalse(bc.downloading_headers)
+        self.assertEqual(bc.height(), 4031)
+        self.assertEqual(bc.connect_chunk(2, self.chunk(2).encode('hex')), 3)
+        self.assertEqual(bc.get_hash(3 * 2016 - 1), hash_encode(Hash(self.chain[-80:])))
+
+    def synced(self, chunks=2):
+        bc = self.make_blockchain(checkpoints=[])
+        bc.init_headers_file()
+        for idx in range(chunks):
+            bc.connect_chunk(idx, self.chunk(idx).encode('hex'))
+        return bc
+
+    def test_reorg(self):
+        bc = self.synced()
+        old_tip = bc.get_hash(4031)
+        # a branch forking at 4020 with faster blocks and a higher tip
+        branch = extend_chain(self.chain[:4021 * 80], 20, spacing=20)
+        headers = header_dicts(branch, 4021)
+        # headers are fetched from the tip down until one does not connect
+        chain = []
+        for h in headers[::-1]:
+            r = bc.connect_header(chain, h)
+            if h['block_height'] == 4031:
+                break
+        self.assertEqual(r, 4030)
+        # the chunk below is searched for the fork point
+        chunk = (self.chain[2016 * 80:4021 * 80] + branch)[:2016 * 80]
+        self.assertTrue(bc.connect_fork(chain, 1, chunk.encode('hex')))
+        self.assertEqual(bc.height(), 4040)
+        self.assertEqual(bc.get_hash(4040), hash_encode(Hash(branch[-80:])))
+        self.assertEqual(bc.get_hash(4020), hash_encode(Hash(self.chain[4020 * 80:4021 * 80])))
+        self.assertEqual(bc.reorgs, [4021])
+        self.assertEqual(bc.get_chainwork(), chain_work(self.chain[:4021 * 80] + branch))
+        # the replaced headers are kept as a side branch
+        self.assertEqual(bc.forks.get(old_tip), (4020, self.chain[4021 * 80:4032 * 80]))
+
+    def test_fork_with_less_work(self):
+        bc = self.synced()
+        work = bc.get_chainwork()
+        branch = extend_chain(self.chain[:4021 * 80], 5, spacing=40)
+        self.assertTrue(bc.connect_branch(4020, header_dicts(branch, 4021)))
+        self.assertEqual(bc.height(), 4031)
+        self.assertEqual(bc.get_chainwork(), work)
+        self.assertEqual(bc.reorgs, [])
+        tip = hash_encode(Hash(branch[-80:]))
+        self.assertEqual(bc.forks.get(tip), (4020, branch))
+        # extending the side branch past the main chain reorgs to it
+        more = extend_chain(self.chain[:4021 * 80] + branch, 10, spacing=40)
+        chain = []
+        headers = header_dicts(more, 4026)
+        for h in headers[::-1]:
+            r = bc.connect_header(chain, h)
+        self.assertTrue(r)
+        self.assertEqual(bc.height(), 4035)
+        self.assertEqual(bc.get_hash(4035), hash_encode(Hash(more[-80:])))
+        self.assertEqual(bc.reorgs, [4021])
+        self.assertIsNone(bc.forks.get(tip))
+
+    def test_branch_bits_are_checked(self):
+        bc = self.synced()
+        branch = extend_chain(self.chain[:4021 * 80], 20, spacing=20)
+        self.assertTrue(bc.verify_bits(4021, branch))
+        # the branch takes precedence over the stored headers above 4021
+        bad = bytearray(branch)
+        bad[15 * 80 + 72] ^= 1
+        bad = relink(self.chain[4020 * 80:4021 * 80] + str(bad))[80:]
+        self.assertFalse(bc.verify_bits(4021, bad))
+        self.assertEqual(bc.height(), 4031)
+
+    def test_chainwork_saved(self):
+        bc = self.synced()
+        work = bc.get_chainwork()
+        bc.chainwork.save()
+        self.assertFalse(os.path.exists(bc.chainwork.path + '.tmp'))
+        bc2 = blockchain.Blockchain(bc.config, None)
+        self.assertEqual(bc2.chainwork.entries, bc.chainwork.entries)
+        self.assertEqual(bc2.get_chainwork(), work)
@@ -0,0 +1,80 @@
+import unittest
+
+from lib import coinchooser
+from lib.bitcoin import TYPE_ADDRESS, hash_160_to_bc_address
+from lib.util import NotEnoughFunds
+
+
+def address(i):
+    return hash_160_to_bc_address(chr(i) * 20)
+
+def coin(i, value, addr=None):
+    return {
+        'prevout_hash': '%064x' % i,
+        'prevout_n': 0,
+        'value': value,
+        'height': 100 + i,
+        'address': addr or address(i),
+        'pubkeys': ['02' + '%064x' % i],
+        'x_pubkeys': ['02' + '%064x' % i],
+        'signatures': [None],
+        'num_sig': 1,
+    }
+
+
+class TestBranchAndBound(unittest.TestCase):
+
+    def setUp(self):
+        self.chooser = coinchooser.CoinChooserBranchAndBound()
+        self.outputs = [(TYPE_ADDRESS, address(200), 250000)]
+        self.change = [address(201)]
+
+    def make_tx(self, values, fee_estimator=lambda size: 0):
+        coins = [coin(i, v) for i, v in enumerate(values)]
+        return self.chooser.make_tx(coins, self.outputs, self.change, fee_estimator, 546)
+
+    def input_values(self, tx):
+        return sorted(txin['value'] for txin in tx.inputs())
+
+    def test_exact_match(self):
+        tx = self.make_tx([50000, 100000, 150000, 400000, 600000])
+        self.assertEqual(250000, sum(self.input_values(tx)))
+        self.assertEqual(self.outputs, tx.outputs())
+
+    def test_exact_match_pays_fee(self):
+        fee = lambda size: size * 10
+        # each input adds 148 bytes, the outputs 44
+        tx = self.make_tx([50000, 101480, 151920, 400000, 600000], fee)
+        self.assertEqual([101480, 151920], self.input_values(tx))
+        self.assertEqual(self.outputs, tx.outputs())
+        self.assertTrue(tx.get_fee() >= fee(tx.estimated_size()))
+
+    def test_fallback(self):
+        # no subset is close enough to avoid change
+        tx = self.make_tx([100000, 200000, 400000])
+        self.assertEqual([400000], self.input_values(tx))
+        self.assertEqual(self.outputs + [(TYPE_ADDRESS, self.change[0], 150000)], tx.outputs())
+        # the largest buckets, completed by the smallest that suffices
+        tx = self.make_tx([130000, 90000, 45000, 35000])
+        self.assertEqual([35000, 90000, 130000], self.input_values(tx))
+
+    def test_not_enough_funds(self):
+        self.assertRaises(NotEnoughFunds, self.make_tx, [100000, 100000])
+        self.assertRaises(NotEnoughFunds, self.make_tx, [])
+        # the fee of spending the coins is more than they are worth
+        self.assertRaises(NotEnoughFunds, self.make_tx, [300000], lambda size: 100000)
+
+    def test_buckets_are_addresses(self):
+        coins = [coin(1, 200000), coin(2, 60000, address(1)), coin(3, 300000)]
+        tx = self.chooser.make_tx(coins, self.outputs, self.change, lambda size: 0, 546)
+        self.assertEqual([60000, 200000], self.input_values(tx))
+
+
+class TestOldestFirst(unittest.TestCase):
+
+    def test_not_enough_funds(self):
+        chooser = coinchooser.CoinChooserOldestFirst()
+        outputs = [(TYPE_ADDRESS, address(200), 250000)]
+        coins = [coin(1, 100000), coin(2, 100000)]
+        self.assertRaises(NotEnoughFunds, chooser.make_tx, coins, outputs,
+                          [address(201)], lambda size: 0, 546)
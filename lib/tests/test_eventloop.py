@@ -0,0 +1,47 @@
+import threading
+import time
+import unittest
+
+from lib import eventloop
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_wakeup(self):
+        threading.Timer(0.05, self.loop.wakeup).start()
+        t0 = time.time()
+        self.assertEqual(self.loop.select([], [], 5), ([], []))
+        self.assertLess(time.time() - t0, 1)
+        # a wakeup before the wait is not lost
+        self.loop.wakeup()
+        t0 = time.time()
+        self.loop.select([], [], 5)
+        self.assertLess(time.time() - t0, 1)
+
+    def test_timers(self):
+        calls = []
+        self.loop.call_later(0.02, lambda: calls.append(2))
+        self.loop.call_later(0.01, lambda: calls.append(1))
+        t = self.loop.call_later(0.01, lambda: calls.append(3))
+        self.loop.cancel(t)
+        while len(calls) < 2:
+            self.loop.select([], [], 5)
+            self.loop.run_timers()
+        self.assertEqual(calls, [1, 2])
+
+    def test_sockets(self):
+        a, b = eventloop.socket_pair()
+        try:
+            self.assertEqual(self.loop.select([a], [a], 0), ([], [a]))
+            b.send('x')
+            self.assertEqual(self.loop.select([a], [], 1), ([a], []))
+            self.assertEqual(self.loop.select([], [], 0), ([], []))
+        finally:
+            a.close()
+            b.close()
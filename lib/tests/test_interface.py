@@ -1,8 +1,22 @@
+import json
+import select
+import socket
+import time
 import unittest
 
 from lib import interface
 
 
+def read_responses(i, n):
+    '''Responses of interface i, until n have arrived'''
+    responses = []
+    deadline = time.time() + 5
+    while len(responses) < n and time.time() < deadline:
+        select.select([i], [], [], 1)
+        responses += i.get_responses()
+    return responses
+
+
 class TestInterface(unittest.TestCase):
 
     def test_match_host_name(self):
@@ -24,3 +38,92 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+    def test_batches(self):
+        a, b = socket.socketpair()
+        try:
+            i = interface.Interface('localhost:1:t', a)
+            i.use_batches = True
+            i.window = 150
+            for n in range(200):
+                i.queue_request('server.version', [], n)
+            self.assertTrue(i.send_requests())
+            b.settimeout(1)
+            data = ''
+            while data.count('\n') < 2:
+                data += b.recv(65536)
+            batches = [json.loads(line) for line in data.splitlines()]
+            self.assertEqual(map(len, batches), [100, 50])
+            self.assertEqual(i.num_requests(), 0)
+            # responses to a batch come back in one array
+            b.sendall(json.dumps([{'id': r['id'], 'result': '1.0'} for r in batches[1]]) + '\n')
+            responses = read_responses(i, 50)
+            self.assertEqual(len(responses), 50)
+            self.assertEqual(i.num_requests(), 50)
+            self.assertEqual(i.pipeline_stats()['batches_sent'], 2)
+            # an error for a whole batch fails the requests of the oldest one
+            error = {'code': -32600, 'message': 'invalid request'}
+            b.sendall(json.dumps({'id': None, 'error': error}) + '\n')
+            responses = read_responses(i, 100)
+            self.assertEqual([r[0][2] for r in responses], range(100))
+            self.assertEqual([r[1] for r in responses], [{'id': n, 'error': error} for n in range(100)])
+            self.assertEqual(i.unanswered_requests, {})
+            # with no batch left, the server is misbehaving
+            b.sendall(json.dumps({'id': None, 'error': error}) + '\n')
+            self.assertEqual(read_responses(i, 1), [(None, None)])
+        finally:
+            a.close()
+            b.close()
+
+    def test_send_does_not_block(self):
+        a, b = socket.socketpair()
+        try:
+            a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            i = interface.Interface('localhost:1:t', a)
+            i.window = i.MAX_WINDOW
+            for n in range(i.MAX_WINDOW):
+                i.queue_request('blockchain.address.get_history', ['x' * 34], n)
+            t0 = time.time()
+            self.assertTrue(i.send_requests())
+            self.assertLess(time.time() - t0, 1)
+            # the rest waits until the socket is writable
+            self.assertTrue(i.pipe.unsent)
+            self.assertTrue(i.wants_write())
+            self.assertEqual(len(i.unanswered_requests), i.MAX_WINDOW)
+            b.settimeout(1)
+            data = ''
+            while data.count('\n') < i.MAX_WINDOW:
+                data += b.recv(65536)
+                r, w, x = select.select([], [i], [], 1)
+                if w:
+                    self.assertTrue(i.send_requests())
+            self.assertEqual([json.loads(line)['id'] for line in data.splitlines()], range(i.MAX_WINDOW))
+            self.assertFalse(i.wants_write())
+        finally:
+            a.close()
+            b.close()
+
+    def test_invalid_batch_element(self):
+        a, b = socket.socketpair()
+        try:
+            i = interface.Interface('localhost:1:t', a)
+            i.queue_request('server.version', [], 0)
+            self.assertTrue(i.send_requests())
+            b.sendall(json.dumps(['x', {'id': 0, 'result': '1.0'}]) + '\n')
+            self.assertEqual(read_responses(i, 1), [(None, None)])
+        finally:
+            a.close()
+            b.close()
+
+    def test_window(self):
+        i = interface.Interface('localhost:1:t', socket.socket())
+        i.unsent_requests = [None]
+        window = i.window
+        for n in range(window):
+            i.update_window(0.1)
+        self.assertEqual(i.window, 2 * window)
+        # requests queue up at the server
+        for n in range(i.window):
+            i.update_window(1)
+        self.assertEqual(i.window, 3 * window / 2)
+        self.assertFalse(i.slow_start)
@@ -0,0 +1,75 @@
+import unittest
+
+from lib import pow_hash
+from lib.bitcoin import Hash
+
+
+HEADER = '\2\0\0\0' + '\0' * 64 + '\0' * 4 + '\xff\xff\x0f\x1e' + '\0' * 4
+
+
+class TestPowHash(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = dict((k, list(v)) for k, v in pow_hash.BACKENDS.items())
+        pow_hash._loaded.clear()
+
+    def tearDown(self):
+        pow_hash.BACKENDS.clear()
+        pow_hash.BACKENDS.update(self.backends)
+        pow_hash._loaded.clear()
+
+    def test_get_algo(self):
+        self.assertEqual(pow_hash.get_algo(2), pow_hash.ALGO_SHA256D)
+        for algo in pow_hash.ALGO_NAMES:
+            version = 2 | (algo << 9)
+            self.assertEqual(pow_hash.get_algo(version), algo)
+            self.assertEqual(pow_hash.get_algo(version | pow_hash.BLOCK_VERSION_AUXPOW), algo)
+        self.assertTrue(pow_hash.is_auxpow(2 | pow_hash.BLOCK_VERSION_AUXPOW))
+        self.assertFalse(pow_hash.is_auxpow(2 | (pow_hash.ALGO_QUBIT << 9)))
+
+    def test_bits_to_target(self):
+        self.assertEqual(pow_hash.bits_to_target(0x1d00ffff), 0xffff << 208)
+        self.assertEqual(pow_hash.bits_to_target(0x1b0404cb), 0x0404cb << 192)
+        self.assertEqual(pow_hash.bits_to_target(0x02123456), 0x1234)
+        self.assertRaises(Exception, pow_hash.bits_to_target, 0x1d800000)
+
+    def test_backend_selection(self):
+        def missing():
+            raise ImportError
+        pow_hash.BACKENDS[pow_hash.ALGO_SKEIN] = [('missing', missing)]
+        self.assertIsNone(pow_hash.get_pow_hash(pow_hash.ALGO_SKEIN))
+        self.assertIn('skein', pow_hash.unavailable_algos())
+        f = lambda h: '\0' * 32
+        pow_hash.register_backend(pow_hash.ALGO_SKEIN, 'test', lambda: f)
+        self.assertIs(pow_hash.get_pow_hash(pow_hash.ALGO_SKEIN), f)
+        self.assertNotIn('skein', pow_hash.unavailable_algos())
+        self.assertIs(pow_hash.get_pow_hash(pow_hash.ALGO_SHA256D), Hash)
+
+    def test_check_pow(self):
+        version = 2 | (pow_hash.ALGO_GROESTL << 9)
+        pow_hash.BACKENDS[pow_hash.ALGO_GROESTL] = []
+        # no backend: not checked
+        self.assertFalse(pow_hash.check_pow(HEADER, version, 0x1e0fffff))
+        pow_hash.register_backend(pow_hash.ALGO_GROESTL, 'low', lambda: lambda h: '\0' * 32)
+        self.assertTrue(pow_hash.check_pow(HEADER, version, 0x1e0fffff))
+        pow_hash.register_backend(pow_hash.ALGO_GROESTL, 'high', lambda: lambda h: '\xff' * 32)
+        self.assertRaises(Exception, pow_hash.check_pow, HEADER, version, 0x1e0fffff)
+        # merge-mined headers are not checked
+        self.assertFalse(pow_hash.check_pow(HEADER, version | pow_hash.BLOCK_VERSION_AUXPOW, 0x1e0fffff))
+        # sha256d uses the hash computed for linkage
+        self.assertTrue(pow_hash.check_pow(HEADER, 2, 0x1e0fffff, '\0' * 32))
+        self.assertRaises(Exception, pow_hash.check_pow, HEADER, 2, 0x1e0fffff, '\xff' * 32)
+        # targets above the limit are rejected
+        self.assertRaises(Exception, pow_hash.check_pow, HEADER, 2, 0x1f0fffff, '\0' * 32)
+
+    def test_check_pow_batch(self):
+        pow_hash.BACKENDS[pow_hash.ALGO_SKEIN] = [('low', lambda: lambda h: '\0' * 32)]
+        pow_hash.BACKENDS[pow_hash.ALGO_QUBIT] = []
+        versions = [2, 2 | (pow_hash.ALGO_SKEIN << 9), 2 | (pow_hash.ALGO_QUBIT << 9),
+                    2 | pow_hash.BLOCK_VERSION_AUXPOW]
+        data = HEADER * len(versions)
+        bits = [0x1e0fffff] * len(versions)
+        hashes = ['\0' * 32] * len(versions)
+        self.assertEqual(pow_hash.check_pow_batch(data, versions, bits, hashes), 2)
+        hashes[0] = '\xff' * 32
+        self.assertRaises(Exception, pow_hash.check_pow_batch, data, versions, bits, hashes)
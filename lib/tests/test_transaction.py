@@ -146,6 +146,49 @@ class TestTransaction(unittest.TestCase):
         self.assertEquals(res, (None, '1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH'))
 
 
+class TestEstimatedSize(unittest.TestCase):
+
+    def txin(self, n, pubkeys, num_sig=1, p2sh=False):
+        from lib.bitcoin import hash160_to_p2pkh
+        txin = {
+            'prevout_hash': '%064x' % n,
+            'prevout_n': n,
+            'address': hash160_to_p2pkh(chr(n % 256) * 20),
+            'pubkeys': pubkeys,
+            'x_pubkeys': pubkeys,
+            'signatures': [None] * len(pubkeys),
+            'num_sig': num_sig,
+        }
+        if p2sh:
+            txin['redeemScript'] = transaction.Transaction.multisig_script(pubkeys, num_sig)
+        return txin
+
+    def assertSize(self, inputs, outputs):
+        tx = transaction.Transaction.from_io(inputs, outputs)
+        for i, txin in enumerate(inputs):
+            self.assertEquals(tx.estimated_input_size(txin), len(tx.serialize_input(txin, i, -1)) / 2)
+        self.assertEquals(tx.estimated_size(), len(tx.serialize(-1)) / 2)
+
+    def test_estimated_size(self):
+        from lib.bitcoin import hash160_to_p2pkh, hash160_to_p2sh, TYPE_SCRIPT
+        compressed = '02' + '11' * 32
+        uncompressed = '04' + '22' * 64
+        outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x01' * 20), 1000),
+                   (TYPE_ADDRESS, hash160_to_p2sh('\x02' * 20), 2000),
+                   (TYPE_SCRIPT, '\x6a' + '\x00' * 80, 0)]
+        inputs = [self.txin(1, [compressed]),
+                  self.txin(2, [uncompressed]),
+                  self.txin(3, [None]),
+                  self.txin(4, [compressed] * 3, 2, True),
+                  self.txin(5, [compressed], 1, True),
+                  self.txin(6, [uncompressed] * 15, 15, True)]
+        self.assertSize(inputs, outputs)
+        self.assertSize([], outputs)
+        self.assertSize(inputs, [])
+        # var_int input and output counts
+        self.assertSize([self.txin(i, [compressed]) for i in range(300)], outputs * 100)
+
+
 class NetworkMock(object):
 
     def __init__(self, unspent):
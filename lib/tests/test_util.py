@@ -1,5 +1,6 @@
+import socket
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, parse_json_lines, SocketPipe, timeout, LRUCache
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +69,61 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+    def test_lru_cache(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.put('c', 3)
+        self.assertNotIn('b', c)
+        self.assertEqual(sorted(c.keys()), ['a', 'c'])
+        c.put('a', 4)
+        c.put('d', 5)
+        self.assertEqual(c.get('a'), 4)
+        self.assertIsNone(c.get('c'))
+        self.assertEqual(c.pop('a'), 4)
+        self.assertEqual(len(c), 1)
+        self.assertEqual(c.items(), [('d', 5)])
+
+
+class SocketMock(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def settimeout(self, t):
+        pass
+
+    def recv_into(self, view, n):
+        if not self.chunks:
+            return 0
+        data = self.chunks.pop(0)
+        if data is None:
+            raise socket.timeout()
+        view[:len(data)] = data
+        return len(data)
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def test_parse_json_lines(self):
+        self.assertEqual(parse_json_lines('{"id": 1}\n[2]'), [{'id': 1}, [2]])
+        # invalid lines are skipped
+        self.assertEqual(parse_json_lines('{"id": 1}\n\n{"id"\n3'), [{'id': 1}, 3])
+        # as are lines that would be valid array elements
+        self.assertEqual(parse_json_lines('1,2\n3'), [3])
+        self.assertEqual(parse_json_lines('[1\n2]\n{"id": 4} '), [{'id': 4}])
+        self.assertEqual(parse_json_lines('{"id": 1} {"id": 2}'), [])
+
+    def test_get(self):
+        big = '{"result": "%s"}' % ('ab' * 100000)
+        data = '{"id": 1}\n' + big + '\nnull\n{"id": 2}\n'
+        chunks = [data[i:i+1000] for i in range(0, 150000, 1000)]
+        chunks += [None, data[150000:]]
+        pipe = SocketPipe(SocketMock(chunks))
+        self.assertEqual(pipe.get(), {'id': 1})
+        self.assertRaises(timeout, pipe.get)
+        self.assertEqual(pipe.get(), {'result': 'ab' * 100000})
+        self.assertEqual(pipe.get(), {'id': 2})
+        # closed remotely
+        self.assertEqual(pipe.get(), None)
@@ -0,0 +1,201 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import verifier
+from lib.bitcoin import Hash, hash_encode, hash_decode
+
+
+def merkle_tree(tx_hashes):
+    '''Levels of the merkle tree of tx_hashes (hex), leaves first'''
+    level = map(hash_decode, tx_hashes)
+    levels = [level]
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def merkle_branch(levels, pos):
+    branch = []
+    for level in levels[:-1]:
+        sibling = pos ^ 1
+        branch.append(hash_encode(level[sibling] if sibling < len(level) else level[pos]))
+        pos >>= 1
+    return branch
+
+
+class FakeBlockchain(object):
+
+    def __init__(self):
+        self.reorgs = []
+
+    def get_hash(self, height):
+        return '%064x' % height
+
+
+class FakeNetwork(object):
+
+    def __init__(self, headers, height):
+        self.headers = headers
+        self.height = height
+        self.blockchain = FakeBlockchain()
+        self.merkle_cache = verifier.MerkleCache(None)
+        self.sent = []
+        self.header_reads = 0
+
+    def get_header(self, height):
+        self.header_reads += 1
+        return self.headers.get(height)
+
+    def get_local_height(self):
+        return self.height
+
+    def send(self, messages, callback):
+        self.sent.append((messages, callback))
+
+
+class FakeWallet(object):
+
+    def __init__(self, unverified):
+        self.unverified = dict(unverified)
+        self.verified = {}
+
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified.pop(tx_hash)
+        self.verified[tx_hash] = info
+
+
+class TestSPV(unittest.TestCase):
+
+    def setUp(self):
+        # two blocks of five transactions
+        self.blocks = {}
+        self.headers = {}
+        for height in (100, 101):
+            txs = ['%02x' % height + '%062x' % i for i in range(5)]
+            levels = merkle_tree(txs)
+            self.blocks[height] = txs, levels
+            self.headers[height] = {'merkle_root': hash_encode(levels[-1][0]), 'timestamp': height}
+        unverified = dict((tx, h) for h, (txs, l) in self.blocks.items() for tx in txs)
+        self.network = FakeNetwork(self.headers, 200)
+        self.wallet = FakeWallet(unverified)
+        self.spv = verifier.SPV(self.network, self.wallet, page_size=4)
+
+    def respond(self, tamper=None):
+        sent, self.network.sent = self.network.sent, []
+        for messages, callback in sent:
+            for method, params in messages:
+                tx_hash, height = params
+                txs, levels = self.blocks[height]
+                pos = txs.index(tx_hash)
+                branch = merkle_branch(levels, pos)
+                if tx_hash == tamper:
+                    branch[0] = '%064x' % 1
+                callback({'params': params, 'result': {
+                    'block_height': height, 'pos': pos, 'merkle': branch}})
+
+    def test_pages(self):
+        self.spv.run()
+        self.assertEqual(len(self.network.sent), 1)
+        self.assertEqual(len(self.network.sent[0][0]), 4)
+        # no more requests while the page is outstanding
+        self.spv.run()
+        self.assertEqual(len(self.network.sent), 1)
+        for i in range(3):
+            self.respond()
+            self.spv.run()
+        self.assertEqual(self.wallet.unverified, {})
+        self.assertEqual(len(self.wallet.verified), 10)
+        self.assertEqual(self.wallet.verified[self.blocks[101][0][3]], (101, 101, 3))
+
+    def test_proofs_grouped_by_block(self):
+        self.spv.page_size = 100
+        self.spv.run()
+        self.respond()
+        self.network.header_reads = 0
+        self.spv.verify_proofs()
+        self.assertEqual(self.network.header_reads, 2)
+        self.assertEqual(len(self.wallet.verified), 10)
+
+    def test_invalid_branch(self):
+        self.spv.page_size = 100
+        bad = self.blocks[100][0][2]
+        self.spv.run()
+        self.respond(tamper=bad)
+        self.spv.verify_proofs()
+        self.assertEqual(self.wallet.unverified, {bad: 100})
+
+    def test_shared_nodes(self):
+        txs, levels = self.blocks[100]
+        root = hash_encode(levels[-1][0])
+        nodes = {}
+        for pos in range(5):
+            branch = merkle_branch(levels, pos)
+            self.assertTrue(self.spv.check_merkle_branch(branch, txs[pos], pos, root, nodes))
+        # a branch conflicting with known nodes fails without reaching the root
+        branch = merkle_branch(levels, 1)
+        self.assertFalse(self.spv.check_merkle_branch(branch, txs[0], 1, root, nodes))
+        self.assertFalse(self.spv.check_merkle_branch(branch, txs[0], 1, root, {}))
+        self.assertEqual(self.spv.hash_merkle_root(merkle_branch(levels, 4), txs[4], 4), root)
+
+
+class TestMerkleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'merkle_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        cache = verifier.MerkleCache(None)
+        cache.add('aa', 100, 3, 'root', 'hash100')
+        self.assertEqual(cache.get('aa', 100, 'hash100'), (3, 'root'))
+        # another height, or the header was replaced
+        self.assertIsNone(cache.get('aa', 101, 'hash100'))
+        self.assertIsNone(cache.get('aa', 100, 'other'))
+        self.assertIsNone(cache.get('bb', 100, 'hash100'))
+
+    def test_undo(self):
+        cache = verifier.MerkleCache(None)
+        cache.add('aa', 100, 0, 'root', 'hash100')
+        cache.add('bb', 200, 0, 'root', 'hash200')
+        cache.undo(150)
+        self.assertIsNotNone(cache.get('aa', 100, 'hash100'))
+        self.assertIsNone(cache.get('bb', 200, 'hash200'))
+
+    def test_size_limit(self):
+        cache = verifier.MerkleCache(None, max_size=2)
+        cache.add('aa', 100, 0, 'root', 'hash100')
+        cache.add('bb', 101, 0, 'root', 'hash101')
+        cache.get('aa', 100, 'hash100')
+        cache.add('cc', 102, 0, 'root', 'hash102')
+        self.assertIsNotNone(cache.get('aa', 100, 'hash100'))
+        self.assertIsNone(cache.get('bb', 101, 'hash101'))
+        self.assertIsNotNone(cache.get('cc', 102, 'hash102'))
+
+    def test_save(self):
+        cache = verifier.MerkleCache(self.path, save_interval=60)
+        cache.add('aa', 100, 1, 'root', 'hash100')
+        cache.add('bb', 101, 2, 'root', 'hash101')
+        cache.save()
+        self.assertFalse(os.path.exists(self.path))
+        cache.save(force=True)
+        loaded = verifier.MerkleCache(self.path, max_size=1)
+        self.assertIsNone(loaded.get('aa', 100, 'hash100'))
+        self.assertEqual(loaded.get('bb', 101, 'hash101'), (2, 'root'))
+
+    def test_load_dict(self):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({'aa': [100, 1, 'root', 'hash100']}))
+        cache = verifier.MerkleCache(self.path)
+        self.assertEqual(cache.get('aa', 100, 'hash100'), (1, 'root'))
@@ -6,6 +6,8 @@ import os
 import json
 
 from StringIO import StringIO
+from electrum import keystore, wallet
+from electrum.bitcoin import TYPE_ADDRESS
 from electrum.storage import WalletStorage, FINAL_SEED_VERSION
 
 
@@ -18,6 +20,24 @@ class FakeSynchronizer(object):
         self.store.append(address)
 
 
+class FakeTx(object):
+    '''Just what the wallet reads from a transaction'''
+
+    def __init__(self, inputs, outputs):
+        self._inputs = [{'prevout_hash': h, 'prevout_n': n, 'address': addr}
+                        for h, n, addr in inputs]
+        self._outputs = [(TYPE_ADDRESS, addr, v) for addr, v in outputs]
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+    def __str__(self):
+        return '00'
+
+
 class WalletTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -67,3 +87,383 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_write_dictionnary_to_sqlite(self):
+
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        storage.put("a", "b")
+        storage.put("transactions", {"aa": "0100", "bb": "0200"})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_sqlite())
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual({"aa": "0100", "bb": "0200"}, storage.get("transactions"))
+
+        storage.put("transactions", {"aa": "0100"})
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"aa": "0100"}, storage.get("transactions"))
+
+    def test_journal_is_replayed(self):
+
+        storage = WalletStorage(self.wallet_path, 'journal')
+        storage.put("a", "b")
+        storage.write()
+        storage.put("c", "d")
+        storage.put("a", None)
+        storage.write()
+        self.assertTrue(os.path.exists(self.wallet_path + ".journal"))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(None, storage.get("a"))
+        self.assertEqual("d", storage.get("c"))
+
+        storage.compact()
+        self.assertFalse(os.path.exists(self.wallet_path + ".journal"))
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual("d", json.loads(f.read())["c"])
+
+    def test_sqlite_transactions_are_read_on_demand(self):
+
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        storage.put_entries("transactions", {"aa": "0100", "bb": "0200"})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertNotIn("transactions", storage.data)
+        self.assertEqual({}, storage.tables)
+        self.assertEqual(["aa", "bb"], sorted(storage.entry_keys("transactions")))
+        self.assertEqual("0200", storage.get_entry("transactions", "bb"))
+        self.assertEqual(None, storage.get_entry("transactions", "cc"))
+
+        # changes are pending until the next write
+        storage.put_entries("transactions", {"aa": None, "cc": "0300"})
+        self.assertEqual(["bb", "cc"], sorted(storage.entry_keys("transactions")))
+        self.assertEqual(None, storage.get_entry("transactions", "aa"))
+        self.assertEqual("0300", storage.get_entry("transactions", "cc"))
+        storage.write()
+        self.assertEqual({}, storage.tables)
+        self.assertEqual("0300", storage.get_entry("transactions", "cc"))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"bb": "0200", "cc": "0300"}, storage.get("transactions"))
+
+    def test_json_transactions_are_kept_as_bytes(self):
+
+        storage = WalletStorage(self.wallet_path, 'journal')
+        storage.put_entries("transactions", {"aa": "0100"})
+        storage.write()
+        storage.put_entries("transactions", {"bb": "0200"})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertNotIn("transactions", storage.data)
+        self.assertEqual({"transactions": {"aa": "\x01\x00", "bb": "\x02\x00"}}, storage.tables)
+        self.assertEqual("0200", storage.get_entry("transactions", "bb"))
+
+        storage.compact()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual({"aa": "0100", "bb": "0200"}, json.loads(f.read())["transactions"])
+
+    def test_transactions_are_converted_to_sqlite(self):
+
+        storage = WalletStorage(self.wallet_path)
+        storage.put_entries("transactions", {"aa": "0100"})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        self.assertTrue(storage.requires_engine_conversion())
+        storage.convert_engine()
+        self.assertEqual({}, storage.tables)
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_sqlite())
+        self.assertEqual({"aa": "0100"}, storage.get("transactions"))
+
+    def test_json_wallet_is_not_converted_on_open(self):
+
+        storage = WalletStorage(self.wallet_path)
+        storage.put("seed_version", FINAL_SEED_VERSION)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        self.assertFalse(storage.requires_upgrade())
+        storage.put("aa", 1)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertFalse(storage.is_sqlite())
+        self.assertEqual(1, storage.get("aa"))
+
+    def test_tx_store(self):
+
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        txs = wallet.TxStore(storage)
+        txs["aa"] = FakeTx([], [])
+        storage.write()
+
+        txs = wallet.TxStore(WalletStorage(self.wallet_path))
+        self.assertIn("aa", txs)
+        self.assertEqual(0, len(txs.cache))
+        self.assertEqual("00", str(txs.get("aa")))
+        self.assertEqual(1, len(txs.cache))
+        self.assertEqual(None, txs.get("bb"))
+        txs.pop("aa")
+        self.assertEqual([], txs.keys())
+        self.assertEqual([], txs.storage.entry_keys("transactions"))
+
+
+class TestAddressIndex(WalletTestCase):
+
+    def test_imported(self):
+        w = wallet.Imported_Wallet(WalletStorage(self.wallet_path))
+        for addr in ['a1', 'a2', 'a3']:
+            w.import_address(addr)
+        self.assertEqual(w.address_index, {'a1': (False, 0), 'a2': (False, 1), 'a3': (False, 2)})
+        self.assertTrue(w.is_mine('a2'))
+        self.assertFalse(w.is_change('a2'))
+        self.assertFalse(w.is_mine('b'))
+        w.delete_address('a1')
+        self.assertEqual(w.address_index, {'a2': (False, 0), 'a3': (False, 1)})
+        self.assertFalse(w.is_mine('a1'))
+        # the index is rebuilt on load
+        w = wallet.Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual(w.address_index, {'a2': (False, 0), 'a3': (False, 1)})
+
+    def test_deterministic(self):
+        storage = WalletStorage(self.wallet_path)
+        k = keystore.BIP32_KeyStore({})
+        k.add_xprv_from_seed('\1' * 32, 'm/')
+        storage.put('keystore', k.dump())
+        storage.put('gap_limit', 5)
+        w = wallet.Standard_Wallet(storage)
+        w.synchronize()
+        receiving, change = w.get_receiving_addresses(), w.get_change_addresses()
+        self.assertEqual((len(receiving), len(change)), (5, 6))
+        self.assertEqual(len(w.address_index), 11)
+        for i, addr in enumerate(receiving):
+            self.assertEqual(w.get_address_index(addr), (False, i))
+            self.assertFalse(w.is_change(addr))
+        for i, addr in enumerate(change):
+            self.assertEqual(w.get_address_index(addr), (True, i))
+            self.assertTrue(w.is_change(addr))
+        self.assertRaises(Exception, w.get_address_index, 'x')
+        # using the last address extends the index
+        w.stored_height = 1000
+        w.history[receiving[-1]] = [('aa', 100)]
+        w.synchronize()
+        self.assertEqual(len(w.get_receiving_addresses()), 10)
+        self.assertEqual(w.get_address_index(w.get_receiving_addresses()[9]), (False, 9))
+
+
+class TestBalanceCache(WalletTestCase):
+
+    def setUp(self):
+        super(TestBalanceCache, self).setUp()
+        self.wallet = wallet.Imported_Wallet(WalletStorage(self.wallet_path))
+        self.wallet.check_balances = True
+        for addr in ['a1', 'a2', 'a3']:
+            self.wallet.import_address(addr)
+        self.fund = FakeTx([('ff' * 32, 0, 'x')], [('a1', 1000), ('a2', 500)])
+        self.spend = FakeTx([('t1', 0, 'a1')], [('x', 700), ('a3', 300)])
+
+    def receive(self, tx_hash, tx, height, addrs):
+        for addr in addrs:
+            hist = [h for h in self.wallet.history.get(addr, []) if h[0] != tx_hash]
+            self.wallet.receive_history_callback(addr, hist + [(tx_hash, height)], {})
+        self.wallet.receive_tx_callback(tx_hash, tx, height)
+
+    def coins(self):
+        return sorted((c['prevout_hash'], c['prevout_n'], c['value'], c['height'])
+                      for c in self.wallet.get_utxos())
+
+    def test_receive_and_spend(self):
+        w = self.wallet
+        self.assertEqual(w.get_balance(), (0, 0, 0))
+        self.receive('t1', self.fund, 0, ['a1', 'a2'])
+        self.assertEqual(w.get_balance(), (0, 1500, 0))
+        self.assertEqual(w.get_addr_balance('a1'), (0, 1000, 0))
+        self.assertEqual(self.coins(), [('t1', 0, 1000, 0), ('t1', 1, 500, 0)])
+        # confirmed
+        self.receive('t1', self.fund, 100, ['a1', 'a2'])
+        self.assertEqual(w.get_balance(), (1500, 0, 0))
+        self.assertEqual(self.coins(), [('t1', 0, 1000, 100), ('t1', 1, 500, 100)])
+        # a1 spends its coin, with change to a3
+        self.receive('t2', self.spend, 0, ['a1', 'a3'])
+        self.assertEqual(w.get_balance(), (1500, -700, 0))
+        self.assertEqual(w.get_addr_balance('a1'), (1000, -1000, 0))
+        self.assertEqual(w.get_addr_utxo('a1'), [])
+        self.assertEqual(self.coins(), [('t1', 1, 500, 100), ('t2', 1, 300, 0)])
+        self.assertEqual(w.get_balance(['a2', 'a3']), (500, 300, 0))
+
+    def test_remove_transaction(self):
+        w = self.wallet
+        self.receive('t1', self.fund, 100, ['a1', 'a2'])
+        self.receive('t2', self.spend, 0, ['a1', 'a3'])
+        # t2 disappears from the histories
+        w.receive_history_callback('a3', [], {})
+        w.receive_history_callback('a1', [('t1', 100)], {})
+        self.assertEqual(w.get_balance(), (1500, 0, 0))
+        self.assertEqual(self.coins(), [('t1', 0, 1000, 100), ('t1', 1, 500, 100)])
+
+    def test_add_unverified_tx(self):
+        w = self.wallet
+        self.receive('t1', self.fund, 0, ['a1', 'a2'])
+        w.get_balance()
+        w.add_unverified_tx('t1', 100)
+        self.assertEqual(w.dirty_addresses, set(['a1', 'a2']))
+        w.get_balance()
+        w.add_unverified_tx('t1', 100)
+        self.assertEqual(w.dirty_addresses, set())
+
+    def test_delete_address(self):
+        w = self.wallet
+        self.receive('t1', self.fund, 100, ['a1', 'a2'])
+        self.assertEqual(w.get_balance(), (1500, 0, 0))
+        w.delete_address('a2')
+        self.assertEqual(w.get_balance(), (1000, 0, 0))
+        self.assertEqual(self.coins(), [('t1', 0, 1000, 100)])
+
+
+class TestHistoryCache(TestBalanceCache):
+
+    def history(self):
+        h = [(tx_hash, height, delta, balance)
+             for tx_hash, height, conf, timestamp, delta, balance in self.wallet.get_history()]
+        full = [(tx_hash, height, delta, balance)
+                for tx_hash, height, conf, timestamp, delta, balance
+                in self.wallet.compute_history(self.wallet.get_addresses())]
+        self.assertEqual(h, full)
+        return h
+
+    def test_receive_and_spend(self):
+        self.assertEqual(self.history(), [])
+        self.receive('t1', self.fund, 0, ['a1', 'a2'])
+        self.assertEqual(self.history(), [('t1', 0, 1500, 1500)])
+        self.receive('t2', self.spend, 0, ['a1', 'a3'])
+        self.assertEqual(self.history(), [('t1', 0, 1500, 1500), ('t2', 0, -700, 800)])
+        # t2 is mined first
+        self.receive('t2', self.spend, 90, ['a1', 'a3'])
+        self.assertEqual(self.history(), [('t2', 90, -700, -700), ('t1', 0, 1500, 800)])
+        self.receive('t1', self.fund, 80, ['a1', 'a2'])
+        self.assertEqual(self.history(), [('t1', 80, 1500, 1500), ('t2', 90, -700, 800)])
+
+    def test_add_unverified_tx(self):
+        self.receive('t1', self.fund, 0, ['a1', 'a2'])
+        self.receive('t2', self.spend, 90, ['a1', 'a3'])
+        self.history()
+        self.wallet.add_unverified_tx('t1', 80)
+        self.assertEqual(self.wallet.dirty_txs, set(['t1']))
+        self.assertEqual([h[0] for h in self.history()], ['t1', 't2'])
+
+    def test_delete_address(self):
+        self.receive('t1', self.fund, 100, ['a1', 'a2'])
+        self.receive('t2', self.spend, 0, ['a1', 'a3'])
+        self.history()
+        self.wallet.delete_address('a3')
+        self.assertEqual(self.history(), [('t1', 100, 1500, 1500), ('t2', 0, -1000, 500)])
+        self.wallet.delete_address('a1')
+        self.assertEqual(self.history(), [('t1', 100, 500, 500)])
+
+
+class TestSpendIndex(WalletTestCase):
+
+    def setUp(self):
+        super(TestSpendIndex, self).setUp()
+        self.wallet = wallet.Imported_Wallet(WalletStorage(self.wallet_path))
+        for addr in ['a1', 'a2', 'a3']:
+            self.wallet.import_address(addr)
+        self.fund = FakeTx([('ff' * 32, 0, 'x')], [('a1', 1000), ('a2', 500)])
+        self.spend = FakeTx([('t1', 0, 'a1'), ('t1', 1, 'a2')], [('a3', 1400)])
+
+    def check_index(self):
+        w = self.wallet
+        spent_by, spent_outpoints = w.spent_by, w.spent_outpoints
+        w.build_spend_index()
+        self.assertEqual(spent_by, w.spent_by)
+        self.assertEqual(spent_outpoints, w.spent_outpoints)
+
+    def test_add(self):
+        w = self.wallet
+        w.add_transaction('t1', self.fund)
+        w.add_transaction('t2', self.spend)
+        self.assertEqual(w.spent_by, {'t1:0': set(['t2']), 't1:1': set(['t2'])})
+        self.assertEqual(w.spent_outpoints, {'t1': set(['t1:0', 't1:1'])})
+        self.check_index()
+
+    def test_add_out_of_order(self):
+        w = self.wallet
+        w.add_transaction('t2', self.spend)
+        self.assertEqual(w.spent_by, {})
+        self.assertEqual(w.pruned_txo, {'t1:0': 't2', 't1:1': 't2'})
+        w.add_transaction('t1', self.fund)
+        self.assertEqual(w.pruned_txo, {})
+        self.assertEqual(w.spent_outpoints, {'t1': set(['t1:0', 't1:1'])})
+        self.check_index()
+
+    def test_remove_spent(self):
+        w = self.wallet
+        w.add_transaction('t1', self.fund)
+        w.add_transaction('t2', self.spend)
+        w.remove_transaction('t1')
+        self.assertEqual(w.spent_by, {})
+        self.assertEqual(w.spent_outpoints, {})
+        self.assertEqual(w.txi['t2'], {})
+        self.assertEqual(w.pruned_txo, {'t1:0': 't2', 't1:1': 't2'})
+        self.check_index()
+        # the outpoints are found again when t1 comes back
+        w.add_transaction('t1', self.fund)
+        self.assertEqual(w.txi['t2'], {'a1': [('t1:0', 1000)], 'a2': [('t1:1', 500)]})
+        self.check_index()
+
+    def test_remove_spender(self):
+        w = self.wallet
+        w.add_transaction('t1', self.fund)
+        w.add_transaction('t2', self.spend)
+        w.add_transaction('t3', FakeTx([('t1', 0, 'a1')], [('x', 900)]))
+        self.assertEqual(w.spent_by['t1:0'], set(['t2', 't3']))
+        w.remove_transaction('t2')
+        self.assertEqual(w.spent_by, {'t1:0': set(['t3'])})
+        self.assertEqual(w.spent_outpoints, {'t1': set(['t1:0'])})
+        self.check_index()
+        w.remove_transaction('t3')
+        self.assertEqual(w.spent_by, {})
+        self.assertEqual(w.spent_outpoints, {})
+
+
+class TestDerivedIndexes(WalletTestCase):
+
+    def setUp(self):
+        super(TestDerivedIndexes, self).setUp()
+        w = wallet.Imported_Wallet(WalletStorage(self.wallet_path))
+        for addr in ['a1', 'a2', 'a3']:
+            w.import_address(addr)
+        w.receive_history_callback('a1', [('t1', 100)], {})
+        w.receive_tx_callback('t1', FakeTx([('ff' * 32, 0, 'x')], [('a1', 1000)]), 100)
+        w.receive_history_callback('a2', [('t2', 0)], {})
+        w.receive_tx_callback('t2', FakeTx([('t1', 0, 'a1')], [('a2', 900)]), 0)
+        self.wallet = w
+
+    def open_wallet(self):
+        w = wallet.Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual(w.tx_addr_hist, self.wallet.tx_addr_hist)
+        self.assertEqual(w.spent_by, self.wallet.spent_by)
+        self.assertEqual(w.spent_outpoints, self.wallet.spent_outpoints)
+        return w
+
+    def test_loaded_after_stop(self):
+        self.wallet.stop_threads()
+        w = self.open_wallet()
+        self.assertTrue(w.load_derived_indexes())
+
+    def test_stale_after_write(self):
+        self.wallet.stop_threads()
+        w = self.open_wallet()
+        w.receive_history_callback('a3', [('t3', 0)], {})
+        w.receive_tx_callback('t3', FakeTx([('t2', 0, 'a2')], [('a3', 800)]), 0)
+        w.save_transactions(write=True)
+        self.wallet = w
+        w = self.open_wallet()
+        self.assertFalse(w.load_derived_indexes())
+        self.assertEqual(w.spent_by['t2:0'], set(['t3']))
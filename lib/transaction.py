@@ -31,7 +31,7 @@
 import bitcoin
 from bitcoin import *
 from bitcoin import hash160_to_p2sh, hash160_to_p2pkh
-from util import print_error, profiler
+from util import print_error
 import time
 import sys
 import struct
@@ -479,13 +479,14 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        sig_hashes = self.signature_hashes(range(len(self.inputs())))
         for i, txin in enumerate(self.inputs()):
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                for_sig = Hash(self.tx_for_sig(i).decode('hex'))
+                for_sig = sig_hashes[i]
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
@@ -493,10 +494,13 @@ class Transaction:
                 pubkeys = txin.get('pubkeys')
                 compressed = True
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, for_sig, curve = SECP256k1)
-                    pubkey = point_to_ser(public_key.pubkey.point, compressed).encode('hex')
+                    pubkey = bitcoin.ec_backend.recover(for_sig, sig_string, recid, compressed)
+                    if pubkey is None:
+                        continue
+                    pubkey = pubkey.encode('hex')
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, for_sig, sigdecode = ecdsa.util.sigdecode_string)
+                        if not bitcoin.ec_backend.verify(pubkey.decode('hex'), for_sig, sig_string):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
                         print_error("adding sig", i, j, pubkey, sig)
                         self._inputs[i]['signatures'][j] = sig
@@ -645,6 +649,38 @@ class Transaction:
     def tx_for_sig(self,i):
         return self.serialize(for_sig = i)
 
+    def signature_hashes(self, indexes):
+        '''Double sha256 of the SIGHASH_ALL preimage of each input in
+        indexes, as a dict.  The parts shared by all preimages are
+        serialized once, in bytes, and the hash state of the common
+        prefix is carried from one input to the next.  Equivalent to
+        Hash(self.tx_for_sig(i).decode('hex')).'''
+        inputs = self.inputs()
+        outputs = self.outputs()
+        outpoints = [txin['prevout_hash'].decode('hex')[::-1] + struct.pack('<I', txin['prevout_n'])
+                     for txin in inputs]
+        sequences = [struct.pack('<I', txin.get('sequence', 0xffffffff)) for txin in inputs]
+        # inputs with an empty script, as in the preimages of other inputs
+        empty = [o + '\x00' + seq for o, seq in zip(outpoints, sequences)]
+        tail = [var_int(len(outputs)).decode('hex')]
+        for output_type, addr, amount in outputs:
+            script = self.pay_script(output_type, addr).decode('hex')
+            tail.append(struct.pack('<Q', amount) + var_int(len(script)).decode('hex') + script)
+        tail.append(struct.pack('<I', self.locktime) + struct.pack('<I', 1))
+        tail = ''.join(tail)
+        prefix = hashlib.sha256(struct.pack('<I', 1) + var_int(len(inputs)).decode('hex'))
+        result = {}
+        for i, txin in enumerate(inputs):
+            if i in indexes:
+                script = self.input_script(txin, i, i).decode('hex')
+                h = prefix.copy()
+                h.update(outpoints[i] + var_int(len(script)).decode('hex') + script + sequences[i])
+                h.update(''.join(empty[i+1:]))
+                h.update(tail)
+                result[i] = hashlib.sha256(h.digest()).digest()
+            prefix.update(empty[i])
+        return result
+
     def hash(self):
         return Hash(self.raw.decode('hex'))[::-1].encode('hex')
 
@@ -668,15 +704,44 @@ class Transaction:
     def is_final(self):
         return not any([x.get('sequence', 0xffffffff) < 0xffffffff - 1 for x in self.inputs()])
 
-    @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(-1)) / 2 if not self.is_complete() or self.raw is None else len(self.raw) / 2 # ASCII hex string
+        if self.is_complete() and self.raw is not None:
+            return len(self.raw) / 2 # ASCII hex string
+        inputs = self.inputs()
+        outputs = self.outputs()
+        return (4 + var_int_size(len(inputs))
+                + sum(self.estimated_input_size(txin) for txin in inputs)
+                + var_int_size(len(outputs))
+                + sum(self.estimated_output_size(o) for o in outputs)
+                + 4)
+
+    @classmethod
+    def estimated_input_script_size(self, txin):
+        '''Length in bytes of input_script(txin, -1, -1), computed from
+        the script type: p2sh m-of-n multisig, or p2pkh with a
+        compressed or uncompressed pubkey, or an imported address whose
+        pubkey is unknown.  Signatures are assumed 0x48 bytes long.'''
+        if txin.get('redeemScript') is not None:
+            # op_0, m signatures, redeem script: op_m, n pubkeys, op_n, op_checkmultisig
+            redeem_script = 3 + sum(push_size(len(k) / 2) for k in txin['pubkeys'])
+            return 1 + txin['num_sig'] * push_size(0x48) + push_size(redeem_script)
+        pubkey = txin['pubkeys'][0]
+        # unknown pubkey: 'fd' + addrtype + hash160
+        return push_size(0x48) + push_size(len(pubkey) / 2 if pubkey is not None else 22)
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        return len(self.serialize_input(txin, -1, -1)) / 2
+        n = self.estimated_input_script_size(txin)
+        # prevout hash and index, script, sequence
+        return 32 + 4 + var_int_size(n) + n + 4
+
+    @classmethod
+    def estimated_output_size(self, output):
+        output_type, addr, amount = output
+        n = len(self.pay_script(output_type, addr)) / 2
+        return 8 + var_int_size(n) + n
 
     def signature_count(self):
         r = 0
@@ -701,7 +766,14 @@ class Transaction:
         return out
 
 
-    def sign(self, keypairs):
+    def sign(self, keypairs, verify=True):
+        '''Signs the inputs we have keys for.  With verify, each new
+        signature is checked against its pubkey.'''
+        to_sign = set(i for i, txin in enumerate(self.inputs())
+                      if any(x_pubkey in keypairs for x_pubkey in txin['x_pubkeys']))
+        sig_hashes = self.signature_hashes(to_sign)
+        # sec -> (EC_KEY, pubkey); a key often signs several inputs
+        ec_keys = {}
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
             for x_pubkey in txin['x_pubkeys']:
@@ -709,25 +781,23 @@ class Transaction:
                 if len(signatures) == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
+                if x_pubkey in keypairs:
                     print_error("adding signature for", x_pubkey)
                     # add pubkey to txin
                     txin = self._inputs[i]
                     x_pubkeys = txin['x_pubkeys']
                     ii = x_pubkeys.index(x_pubkey)
                     sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec)
+                    if sec not in ec_keys:
+                        pkey = regenerate_key(sec)
+                        ec_keys[sec] = pkey, pkey.get_public_key(is_compressed(sec))
+                    pkey, pubkey = ec_keys[sec]
                     txin['x_pubkeys'][ii] = pubkey
                     txin['pubkeys'][ii] = pubkey
                     self._inputs[i] = txin
                     # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+                    for_sig = sig_hashes[i]
+                    sig = pkey.sign(for_sig, sigencode = ecdsa.util.sigencode_der, verify = verify)
                     txin['signatures'][ii] = sig.encode('hex')
                     self._inputs[i] = txin
         print_error("is_complete", self.is_complete())
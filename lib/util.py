@@ -26,7 +26,7 @@
 import os, sys, re, json
 import platform
 import shutil
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -496,6 +496,21 @@ def parse_json(message):
     return j, message[n+1:]
 
 
+json_decoder = json.JSONDecoder()
+
+def parse_json_lines(data):
+    '''Decodes a string of complete JSON lines, each one on its own.
+    Invalid lines are skipped, as in parse_json.'''
+    out = []
+    for line in data.split('\n'):
+        line = line.strip()
+        try:
+            j, end = json_decoder.raw_decode(line)
+        except ValueError:
+            continue
+        if end == len(line):
+            out.append(j)
+    return out
 
 
 class timeout(Exception):
@@ -509,9 +524,19 @@ import time
 
 class SocketPipe:
 
+    # received data is kept in one bytearray, and each byte is scanned
+    # for newlines once; the buffer grows by doubling for large responses
+    BUFFER_SIZE = 1 << 16
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = ''
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        # buffer[start:end] is received data not yet decoded, and there
+        # is no newline in buffer[start:scanned]
+        self.start = self.end = self.scanned = 0
+        self.responses = deque()
+        # data queued by queue_all() that the socket has not taken yet
+        self.unsent = ''
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -523,11 +548,10 @@ class SocketPipe:
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            if self.responses:
+                return self.responses.popleft()
             try:
-                data = self.socket.recv(1024)
+                n = self.recv()
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -536,20 +560,53 @@ class SocketPipe:
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
-                    print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
+                    # the normal end of data of a non-blocking socket
+                    if self.socket.gettimeout() != 0:
+                        print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
+                        time.sleep(0.2)
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
-                    data = ''
+                    n = 0
             except:
                 traceback.print_exc(file=sys.stderr)
-                data = ''
+                n = 0
 
-            if not data:  # Connection closed remotely
+            if not n:  # Connection closed remotely
                 return None
-            self.message += data
             self.recv_time = time.time()
+            self.decode_lines()
+
+    def recv(self):
+        if len(self.buffer) - self.end < self.BUFFER_SIZE / 4:
+            # move the partial line to the front, of a new buffer twice
+            # as large if needed (a bytearray with views is not resizable)
+            size = self.end - self.start
+            buf = self.buffer
+            if len(buf) - size < self.BUFFER_SIZE / 4:
+                buf = bytearray(2 * len(buf))
+            buf[:size] = self.buffer[self.start:self.end]
+            self.buffer = buf
+            self.scanned -= self.start
+            self.start, self.end = 0, size
+        view = memoryview(self.buffer)[self.end:]
+        n = self.socket.recv_into(view, len(view))
+        self.end += n
+        return n
+
+    def decode_lines(self):
+        '''Decodes the complete lines received so far'''
+        n = self.buffer.rfind('\n', self.scanned, self.end)
+        if n == -1:
+            self.scanned = self.end
+            return
+        data = str(self.buffer[self.start:n])
+        self.start = self.scanned = n + 1
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+            if len(self.buffer) > self.BUFFER_SIZE:
+                self.buffer = bytearray(self.BUFFER_SIZE)
+        self.responses.extend(r for r in parse_json_lines(data) if r is not None)
 
     def send(self, request):
         out = json.dumps(request) + '\n'
@@ -559,6 +616,28 @@ class SocketPipe:
         out = ''.join(map(lambda x: json.dumps(x) + '\n', requests))
         self._send(out)
 
+    def queue_all(self, requests):
+        '''Queues requests to be sent by flush()'''
+        self.unsent += ''.join(json.dumps(x) + '\n' for x in requests)
+
+    def flush(self):
+        '''Sends as much of the queued data as a non-blocking socket takes.
+        Returns True once all of it is sent, False if the rest must wait
+        until the socket is writable.  Raises socket.error on failure.'''
+        while self.unsent:
+            try:
+                sent = self.socket.send(self.unsent)
+            except ssl.SSLError as e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+                    return False
+                raise
+            except socket.error as e:
+                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return False
+                raise
+            self.unsent = self.unsent[sent:]
+        return True
+
     def _send(self, out):
         while out:
             try:
@@ -620,6 +699,49 @@ class QueuePipe:
 
 
 
+class LRUCache(object):
+    '''A bounded mapping that evicts the least recently used entry
+    once more than maxsize entries are stored.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        '''Entries from the least to the most recently used'''
+        return self.data.items()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+
+
 class StoreDict(dict):
 
     def __init__(self, config, name):
@@ -24,58 +24,238 @@
 # SOFTWARE.
 
 
-from util import ThreadJob
+import os
+import json
+import time
+import threading
+
+from util import ThreadJob, PrintError, LRUCache
 from bitcoin import *
 
 
+class MerkleCache(PrintError):
+    '''Verified merkle branches, shared by the wallets of a daemon and
+    persisted in the config directory: tx hash -> (height, pos, merkle
+    root, header hash).  An entry is only used while the header at its
+    height still has the hash it was verified against, so a reorg that
+    was not reported through undo() cannot make it valid.  At most
+    max_size entries are kept, the least recently used are dropped.'''
+
+    def __init__(self, path, save_interval=10, max_size=100000):
+        self.path = path
+        self.save_interval = save_interval
+        self.lock = threading.RLock()
+        self.entries = LRUCache(max_size)
+        self.modified = False
+        self.last_save = time.time()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    items = json.loads(f.read())
+                # older files hold a dict, in no particular order
+                if isinstance(items, dict):
+                    items = items.items()
+                for tx_hash, item in items:
+                    self.entries.put(tx_hash, item)
+            except Exception as e:
+                self.print_error("cannot read", path, str(e))
+
+    def get(self, tx_hash, tx_height, header_hash):
+        '''(pos, merkle root) of a branch verified against the header at
+        tx_height with hash header_hash, or None'''
+        with self.lock:
+            item = self.entries.get(tx_hash)
+        if item is None or item[0] != tx_height or item[3] != header_hash:
+            return None
+        return item[1], item[2]
+
+    def add(self, tx_hash, tx_height, pos, merkle_root, header_hash):
+        with self.lock:
+            self.entries.put(tx_hash, (tx_height, pos, merkle_root, header_hash))
+            self.modified = True
+
+    def undo(self, height):
+        with self.lock:
+            for tx_hash, item in self.entries.items():
+                if item[0] >= height:
+                    self.entries.pop(tx_hash)
+                    self.modified = True
+
+    def save(self, force=False):
+        '''Write the cache, at most every save_interval seconds unless
+        forced'''
+        with self.lock:
+            if not self.path or not self.modified:
+                return
+            if not force and time.time() - self.last_save < self.save_interval:
+                return
+            s = json.dumps(self.entries.items())
+            self.modified = False
+            self.last_save = time.time()
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(s)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except Exception as e:
+            self.print_error("cannot save", self.path, str(e))
+
+
 class SPV(ThreadJob):
-    """ Simple Payment Verification """
+    """ Simple Payment Verification
+
+    Merkle branches are requested in pages of at most page_size
+    outstanding requests.  Responses are queued and verified on the
+    next run, grouped by block height: each header is read once, and
+    the nodes of branches already verified for a block are shared, so
+    a branch stops hashing as soon as it reaches a known node.
+    """
 
-    def __init__(self, network, wallet):
+    def __init__(self, network, wallet, page_size=100, timeout=120):
         self.wallet = wallet
         self.network = network
+        self.page_size = page_size
+        self.timeout = timeout
         # Keyed by tx hash.  Value is None if the merkle branch was
         # requested, and the merkle root once it has been verified
         self.merkle_roots = {}
+        # tx hash -> time of the outstanding request
+        self.requested = {}
+        # chunk index -> time of the request, for missing headers
+        self.requested_chunks = {}
+        # block height -> list of (tx hash, merkle response)
+        self.proofs = {}
+        self.cache = network.merkle_cache
+        self.reorgs_seen = len(network.blockchain.reorgs)
 
     def run(self):
+        reorgs = self.network.blockchain.reorgs
+        if len(reorgs) > self.reorgs_seen:
+            self.undo_verifications(min(reorgs[self.reorgs_seen:]))
+            self.reorgs_seen = len(reorgs)
+        self.verify_proofs()
+        now = time.time()
+        for tx_hash, t in self.requested.items():
+            if now - t > self.timeout:
+                # lost with its interface; ask again
+                self.requested.pop(tx_hash)
+                self.merkle_roots.pop(tx_hash, None)
         lh = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
+        requests = []
         for tx_hash, tx_height in unverified.items():
+            if len(self.requested) >= self.page_size:
+                break
             # do not request merkle branch before headers are available
             if tx_height>0 and tx_hash not in self.merkle_roots and tx_height <= lh:
-                request = ('blockchain.transaction.get_merkle',
-                           [tx_hash, tx_height])
-                self.network.send([request], self.verify_merkle)
-                self.print_error('requested merkle', tx_hash)
+                if self.network.get_header(tx_height) is None:
+                    # below the checkpoint the download started from
+                    self.request_chunk(tx_height / 2016)
+                    continue
+                if self.verify_from_cache(tx_hash, tx_height):
+                    continue
+                requests.append(('blockchain.transaction.get_merkle',
+                                 [tx_hash, tx_height]))
                 self.merkle_roots[tx_hash] = None
+                self.requested[tx_hash] = now
+        if requests:
+            self.network.send(requests, self.on_merkle)
+            self.print_error('requested %d merkle branches' % len(requests))
+        self.cache.save()
+
+    def request_chunk(self, idx):
+        t = self.requested_chunks.get(idx)
+        if t is not None and time.time() - t < self.timeout:
+            return
+        self.requested_chunks[idx] = time.time()
+        self.network.send([('blockchain.block.get_chunk', [idx])], self.on_chunk)
+        self.print_error('requested chunk %d' % idx)
 
-    def verify_merkle(self, r):
+    def on_chunk(self, r):
+        idx = r['params'][0]
         if r.get('error'):
             self.print_error('received an error:', r)
             return
+        try:
+            self.network.blockchain.fill_chunk(idx, r['result'])
+        except BaseException as e:
+            self.print_error('cannot fill chunk %d:' % idx, str(e))
+            return
+        self.requested_chunks.pop(idx, None)
+
+    def verify_from_cache(self, tx_hash, tx_height):
+        header_hash = self.network.blockchain.get_hash(tx_height)
+        item = self.cache.get(tx_hash, tx_height, header_hash)
+        if item is None:
+            return False
+        pos, merkle_root = item
+        header = self.network.get_header(tx_height)
+        if not header or header.get('merkle_root') != merkle_root:
+            return False
+        self.merkle_roots[tx_hash] = merkle_root
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        return True
 
-        params = r['params']
+    def on_merkle(self, r):
+        tx_hash = r['params'][0]
+        self.requested.pop(tx_hash, None)
+        if r.get('error'):
+            self.print_error('received an error:', r)
+            return
         merkle = r['result']
+        self.proofs.setdefault(merkle.get('block_height'), []).append((tx_hash, merkle))
 
+    def verify_proofs(self):
+        proofs, self.proofs = self.proofs, {}
+        for tx_height, items in sorted(proofs.items()):
+            header = self.network.get_header(tx_height)
+            nodes = {}
+            for tx_hash, merkle in items:
+                self.verify_merkle(tx_hash, merkle, header, nodes)
+
+    def verify_merkle(self, tx_hash, merkle, header, nodes):
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
-        tx_hash = params[0]
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
-        merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        header = self.network.get_header(tx_height)
-        if not header or header.get('merkle_root') != merkle_root:
+        if not header or not self.check_merkle_branch(merkle['merkle'], tx_hash, pos,
+                                                      header.get('merkle_root'), nodes):
             # FIXME: we should make a fresh connection to a server to
             # recover from this, as this TX will now never verify
             self.print_error("merkle verification failed for", tx_hash)
             return
 
         # we passed all the tests
-        self.merkle_roots[tx_hash] = merkle_root
+        self.merkle_roots[tx_hash] = header.get('merkle_root')
+        self.cache.add(tx_hash, tx_height, pos, header.get('merkle_root'),
+                       self.network.blockchain.get_hash(tx_height))
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
 
+    def check_merkle_branch(self, merkle_s, target_hash, pos, merkle_root, nodes):
+        '''Checks a branch against merkle_root.  nodes maps (level, index)
+        to the raw nodes of the block proven by earlier branches; it is
+        extended with the nodes and siblings of this one.'''
+        h = hash_decode(target_hash)
+        path = []
+        for i in range(len(merkle_s)):
+            index = pos >> i
+            known = nodes.get((i, index))
+            if known is not None:
+                if known != h:
+                    return False
+                break
+            item = hash_decode(merkle_s[i])
+            path.append(((i, index), h))
+            path.append(((i, index ^ 1), item))
+            h = Hash(item + h) if (index & 1) else Hash(h + item)
+        else:
+            if hash_encode(h) != merkle_root:
+                return False
+        nodes.update(path)
+        return True
 
     def hash_merkle_root(self, merkle_s, target_hash, pos):
         h = hash_decode(target_hash)
@@ -86,6 +266,7 @@ class SPV(ThreadJob):
 
 
     def undo_verifications(self, height):
+        self.cache.undo(height)
         tx_hashes = self.wallet.undo_verifications(height)
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
@@ -32,6 +32,7 @@ Wallet classes:
 """
 
 import os
+import bisect
 import hashlib
 import ast
 import threading
@@ -45,7 +46,7 @@ from functools import partial
 from collections import namedtuple, defaultdict
 
 from i18n import _
-from util import NotEnoughFunds, PrintError, UserCancelled, profiler
+from util import NotEnoughFunds, PrintError, UserCancelled, profiler, LRUCache
 
 from bitcoin import *
 from version import *
@@ -64,6 +65,9 @@ import paymentrequest
 
 from storage import WalletStorage
 
+# version of the derived indexes saved in the wallet file
+DERIVED_INDEXES_VERSION = 2
+
 TX_STATUS = [
     _('Replaceable'),
     _('Unconfirmed parent'),
@@ -73,6 +77,63 @@ TX_STATUS = [
 ]
 
 
+class TxStore(object):
+    '''Wallet transactions by hash.  The raw transactions are only kept
+    in the wallet storage; Transaction objects are created on demand and
+    a bounded number of them is cached.'''
+
+    cache_size = 1000
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        self.hashes = set(storage.entry_keys('transactions'))
+        self.cache = LRUCache(self.cache_size)
+
+    def get(self, tx_hash, default=None):
+        with self.lock:
+            tx = self.cache.get(tx_hash)
+            if tx is not None:
+                return tx
+            if tx_hash not in self.hashes:
+                return default
+            raw = self.storage.get_entry('transactions', tx_hash)
+            if raw is None:
+                return default
+            tx = Transaction(raw)
+            self.cache.put(tx_hash, tx)
+            return tx
+
+    def get_raw(self, tx_hash):
+        return self.storage.get_entry('transactions', tx_hash)
+
+    def __setitem__(self, tx_hash, tx):
+        with self.lock:
+            self.hashes.add(tx_hash)
+            self.cache.put(tx_hash, tx)
+            self.storage.put_entries('transactions', {tx_hash: str(tx)})
+
+    def pop(self, tx_hash, default=None):
+        with self.lock:
+            if tx_hash not in self.hashes:
+                return default
+            tx = self.get(tx_hash)
+            self.hashes.discard(tx_hash)
+            self.cache.pop(tx_hash)
+            self.storage.put_entries('transactions', {tx_hash: None})
+            return tx
+
+    def keys(self):
+        with self.lock:
+            return list(self.hashes)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+
 
 class Abstract_Wallet(PrintError):
     """
@@ -101,8 +162,12 @@ class Abstract_Wallet(PrintError):
 
         self.load_keystore()
         self.load_addresses()
+        self.build_address_index()
         self.load_transactions()
-        self.build_reverse_history()
+        indexes_loaded = self.load_derived_indexes()
+        if not indexes_loaded:
+            self.build_spend_index()
+            self.build_reverse_history()
 
         # load requests
         self.receive_requests = self.storage.get('payment_requests', {})
@@ -121,7 +186,19 @@ class Abstract_Wallet(PrintError):
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
 
-        self.check_history()
+        # Balances and coins per address, recomputed lazily for the
+        # addresses touched since the last query.  Set check_balances
+        # to compare every query with a full recomputation.
+        self.balance_lock = threading.RLock()
+        self.check_balances = False
+        self.clear_balance_cache()
+        # Sorted wallet history, updated for the transactions touched
+        # since the last query
+        self.history_lock = threading.RLock()
+        self.clear_history_cache()
+
+        if not indexes_loaded:
+            self.check_history()
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -142,22 +219,17 @@ class Abstract_Wallet(PrintError):
         self.txo = self.storage.get('txo', {})
         self.tx_fees = self.storage.get('tx_fees', {})
         self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        self.transactions = TxStore(self.storage)
+        pruned = set(self.pruned_txo.values())
+        for tx_hash in self.transactions.keys():
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in pruned):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
 
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
+            # transactions are written to storage by TxStore
             self.storage.put('txi', self.txi)
             self.storage.put('txo', self.txo)
             self.storage.put('tx_fees', self.tx_fees)
@@ -172,10 +244,41 @@ class Abstract_Wallet(PrintError):
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            self.build_spend_index()
         self.save_transactions()
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+        self.clear_balance_cache()
+        self.clear_history_cache()
+
+    def build_spend_index(self):
+        '''Reverse index of txi: outpoint -> hashes of the transactions
+        spending it, and tx hash -> its outpoints that are spent.
+        Entries may be stale; txi is authoritative.'''
+        self.spent_by = {}
+        self.spent_outpoints = {}
+        for tx_hash, d in self.txi.items():
+            for addr, l in d.items():
+                for ser, v in l:
+                    self.add_spend(ser, tx_hash)
+
+    def add_spend(self, ser, tx_hash):
+        self.spent_by.setdefault(ser, set()).add(tx_hash)
+        self.spent_outpoints.setdefault(ser.split(':')[0], set()).add(ser)
+
+    def remove_spend(self, ser, tx_hash):
+        s = self.spent_by.get(ser)
+        if s is None:
+            return
+        s.discard(tx_hash)
+        if not s:
+            self.spent_by.pop(ser)
+            prev_hash = ser.split(':')[0]
+            outpoints = self.spent_outpoints.get(prev_hash, set())
+            outpoints.discard(ser)
+            if not outpoints:
+                self.spent_outpoints.pop(prev_hash, None)
 
     @profiler
     def build_reverse_history(self):
@@ -189,6 +292,7 @@ class Abstract_Wallet(PrintError):
     @profiler
     def check_history(self):
         save = False
+        pruned = set(self.pruned_txo.values())
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
                 self.history.pop(addr)
@@ -196,7 +300,7 @@ class Abstract_Wallet(PrintError):
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in pruned or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -205,6 +309,36 @@ class Abstract_Wallet(PrintError):
         if save:
             self.save_transactions()
 
+    @profiler
+    def save_derived_indexes(self):
+        '''Saves tx_addr_hist and the spend index, so that the next open
+        can skip build_reverse_history, build_spend_index and
+        check_history if the wallet was not modified in between.
+        They are stamped with the storage revision of the next write;
+        any later write makes them stale.'''
+        with self.transaction_lock:
+            d = {
+                'version': DERIVED_INDEXES_VERSION,
+                'revision': self.storage.next_revision(),
+                'tx_addr_hist': dict((k, list(v)) for k, v in self.tx_addr_hist.items()),
+                'spent_by': dict((k, list(v)) for k, v in self.spent_by.items()),
+                'spent_outpoints': dict((k, list(v)) for k, v in self.spent_outpoints.items()),
+            }
+        self.storage.put('derived_indexes', d)
+
+    @profiler
+    def load_derived_indexes(self):
+        d = self.storage.get('derived_indexes')
+        if not d or d.get('version') != DERIVED_INDEXES_VERSION:
+            return False
+        if d.get('revision') != self.storage.get_revision():
+            self.print_error("derived indexes are stale")
+            return False
+        self.tx_addr_hist = dict((k, set(v)) for k, v in d['tx_addr_hist'].items())
+        self.spent_by = dict((k, set(v)) for k, v in d['spent_by'].items())
+        self.spent_outpoints = dict((k, set(v)) for k, v in d['spent_outpoints'].items())
+        return True
+
     def basename(self):
         return os.path.basename(self.storage.path)
 
@@ -218,6 +352,16 @@ class Abstract_Wallet(PrintError):
         self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
         self.change_addresses = map(self.pubkeys_to_address, self.change_pubkeys)
 
+    def build_address_index(self):
+        '''Map each address to (is_change, n), its position in the
+        change or receiving list.  Must be rebuilt or updated whenever
+        those lists change.'''
+        self.address_index = {}
+        for i, addr in enumerate(self.change_addresses):
+            self.address_index[addr] = (True, i)
+        for i, addr in enumerate(self.receiving_addresses):
+            self.address_index[addr] = (False, i)
+
     def synchronize(self):
         pass
 
@@ -249,22 +393,17 @@ class Abstract_Wallet(PrintError):
         return changed
 
     def is_mine(self, address):
-        return address in self.get_addresses()
+        return address in self.address_index
 
     def is_change(self, address):
-        if not self.is_mine(address):
-            return False
-        return address in self.change_addresses
+        return self.address_index.get(address, (False, None))[0]
 
     def get_address_index(self, address):
+        if address not in self.address_index:
+            raise Exception("Address not found", address)
         if self.keystore.can_import():
-            i = self.receiving_addresses.index(address)
-            return self.receiving_pubkeys[i]
-        elif address in self.receiving_addresses:
-            return False, self.receiving_addresses.index(address)
-        if address in self.change_addresses:
-            return True, self.change_addresses.index(address)
-        raise Exception("Address not found", address)
+            return self.receiving_pubkeys[self.address_index[address][1]]
+        return self.address_index[address]
 
     def get_pubkey_index(self, pubkey):
         if self.keystore.can_import():
@@ -285,8 +424,7 @@ class Abstract_Wallet(PrintError):
 
     def get_public_key(self, address):
         if self.keystore.can_import():
-            i = self.receiving_addresses.index(address)
-            pubkey = self.receiving_pubkeys[i]
+            pubkey = self.get_address_index(address)
         else:
             sequence = self.get_address_index(address)
             pubkey = self.get_pubkey(*sequence)
@@ -299,6 +437,9 @@ class Abstract_Wallet(PrintError):
     def add_unverified_tx(self, tx_hash, tx_height):
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
+            if self.unverified_tx.get(tx_hash) != tx_height:
+                self.invalidate_balances(self.tx_addr_hist.get(tx_hash, []))
+                self.invalidate_history([tx_hash])
             self.unverified_tx[tx_hash] = tx_height
 
     def add_verified_tx(self, tx_hash, info):
@@ -306,6 +447,8 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+        self.invalidate_balances(self.tx_addr_hist.get(tx_hash, []))
+        self.invalidate_history([tx_hash])
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -317,11 +460,15 @@ class Abstract_Wallet(PrintError):
         '''Used by the verifier when a reorg has happened'''
         txs = []
         with self.lock:
-            for tx_hash, item in self.verified_tx:
+            for tx_hash, item in self.verified_tx.items():
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
                     self.verified_tx.pop(tx_hash, None)
+                    self.unverified_tx[tx_hash] = tx_height
                     txs.append(tx_hash)
+        for tx_hash in txs:
+            self.invalidate_balances(self.tx_addr_hist.get(tx_hash, []))
+        self.invalidate_history(txs)
         return txs
 
     def get_local_height(self):
@@ -377,7 +524,7 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
+        addresses = self.address_index
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -437,7 +584,7 @@ class Abstract_Wallet(PrintError):
         height = conf = timestamp = None
         if tx.is_complete():
             tx_hash = tx.hash()
-            if tx_hash in self.transactions.keys():
+            if tx_hash in self.transactions:
                 label = self.get_label(tx_hash)
                 height, conf, timestamp = self.get_tx_height(tx_hash)
                 if height > 0:
@@ -490,8 +637,91 @@ class Abstract_Wallet(PrintError):
                 sent[txi] = height
         return received, sent
 
+    def clear_balance_cache(self):
+        with self.balance_lock:
+            # address -> (confirmed, unconfirmed, [(height, value)] of
+            # coinbase outputs, list of coins)
+            self.addr_balances = {}
+            # 'prevout_hash:n' -> coin, for every address
+            self.utxo_set = {}
+            # wallet totals of the first two items of addr_balances
+            self.balance_totals = [0, 0]
+            # address -> coinbase outputs, for the addresses that have any
+            self.coinbase_outputs = {}
+            self.dirty_addresses = set(self.history.keys())
+
+    def invalidate_balances(self, addresses):
+        with self.balance_lock:
+            self.dirty_addresses.update(addresses)
+
+    def update_balances(self):
+        '''Recompute the balance entries of the addresses touched since
+        the last call'''
+        with self.balance_lock:
+            dirty, self.dirty_addresses = self.dirty_addresses, set()
+            for addr in dirty:
+                old = self.addr_balances.pop(addr, None)
+                self.coinbase_outputs.pop(addr, None)
+                if old is not None:
+                    self.balance_totals[0] -= old[0]
+                    self.balance_totals[1] -= old[1]
+                    for coin in old[3]:
+                        self.utxo_set.pop(coin['prevout_hash'] + ':%d' % coin['prevout_n'], None)
+                if addr not in self.address_index:
+                    continue
+                item = self.compute_addr_balance(addr)
+                self.addr_balances[addr] = item
+                if item[2]:
+                    self.coinbase_outputs[addr] = item[2]
+                self.balance_totals[0] += item[0]
+                self.balance_totals[1] += item[1]
+                for coin in item[3]:
+                    self.utxo_set[coin['prevout_hash'] + ':%d' % coin['prevout_n']] = coin
+
+    def compute_addr_balance(self, address):
+        '''Balance entry of an address.  Coinbase outputs are kept apart
+        because their maturity depends on the local height.'''
+        received, sent = self.get_addr_io(address)
+        c = u = 0
+        coinbase = []
+        for txo, (tx_height, v, is_cb) in received.items():
+            if is_cb:
+                coinbase.append((tx_height, v))
+            elif tx_height > 0:
+                c += v
+            else:
+                u += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    c -= v
+                else:
+                    u -= v
+        return c, u, coinbase, self.get_addr_utxo_uncached(address, received, sent)
+
+    def add_coinbase_balance(self, balance, coinbase):
+        c, u, x = balance
+        local_height = self.get_local_height()
+        for tx_height, v in coinbase:
+            if tx_height + COINBASE_MATURITY > local_height:
+                x += v
+            elif tx_height > 0:
+                c += v
+            else:
+                u += v
+        return c, u, x
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
+        self.update_balances()
+        item = self.addr_balances.get(address)
+        if self.check_balances:
+            fresh = self.get_addr_utxo_uncached(address)
+            assert sorted(fresh) == sorted(item[3] if item else []), "utxo cache mismatch for %s" % address
+        return map(dict, item[3]) if item else []
+
+    def get_addr_utxo_uncached(self, address, coins=None, spent=None):
+        if coins is None:
+            coins, spent = self.get_addr_io(address)
+        coins = dict(coins)
         for txi in spent:
             coins.pop(txi)
         out = []
@@ -516,6 +746,18 @@ class Abstract_Wallet(PrintError):
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
+        self.update_balances()
+        item = self.addr_balances.get(address)
+        if item is None:
+            balance = 0, 0, 0
+        else:
+            balance = self.add_coinbase_balance((item[0], item[1], 0), item[2])
+        if self.check_balances:
+            fresh = self.get_addr_balance_uncached(address)
+            assert balance == fresh, "balance cache mismatch for %s: %s vs %s" % (address, balance, fresh)
+        return balance
+
+    def get_addr_balance_uncached(self, address):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
         for txo, (tx_height, v, is_cb) in received.items():
@@ -538,16 +780,21 @@ class Abstract_Wallet(PrintError):
     def get_utxos(self, domain = None, exclude_frozen = False, mature = False):
         coins = []
         if domain is None:
-            domain = self.get_addresses()
-        if exclude_frozen:
-            domain = set(domain) - self.frozen_addresses
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos:
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                coins.append(x)
+            self.update_balances()
+            with self.balance_lock:
+                utxos = map(dict, self.utxo_set.values())
+            if exclude_frozen:
+                utxos = [x for x in utxos if x['address'] not in self.frozen_addresses]
+        else:
+            if exclude_frozen:
+                domain = set(domain) - self.frozen_addresses
+            utxos = []
+            for addr in domain:
+                utxos += self.get_addr_utxo(addr)
+        for x in utxos:
+            if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
                 continue
+            coins.append(x)
         return coins
 
     def dummy_address(self):
@@ -564,7 +811,15 @@ class Abstract_Wallet(PrintError):
 
     def get_balance(self, domain=None):
         if domain is None:
-            domain = self.get_addresses()
+            self.update_balances()
+            with self.balance_lock:
+                balance = self.balance_totals[0], self.balance_totals[1], 0
+                for coinbase in self.coinbase_outputs.values():
+                    balance = self.add_coinbase_balance(balance, coinbase)
+            if self.check_balances:
+                fresh = self.get_balance(self.get_addresses())
+                assert balance == fresh, "balance cache mismatch: %s vs %s" % (balance, fresh)
+            return balance
         cc = uu = xx = 0
         for addr in domain:
             c, u, x = self.get_addr_balance(addr)
@@ -606,6 +861,7 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self.add_spend(ser, tx_hash)
                             break
                     else:
                         self.pruned_txo[ser] = tx_hash
@@ -633,30 +889,51 @@ class Abstract_Wallet(PrintError):
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.add_spend(ser, next_tx)
+                    self.invalidate_balances([addr])
+                    self.invalidate_history([next_tx])
             # save
             self.transactions[tx_hash] = tx
+            self.invalidate_balances(self.txi[tx_hash].keys() + self.txo[tx_hash].keys())
+            self.invalidate_history([tx_hash])
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in self.pruned_txo.items():
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
-            # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
-                for addr, l in dd.items():
-                    ll = l[:]
-                    for item in ll:
-                        ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
-                            l.remove(item)
-                            self.pruned_txo[ser] = next_tx
-                    if l == []:
-                        dd.pop(addr)
-                    else:
-                        dd[addr] = l
+            tx = self.transactions.get(tx_hash)
+            if tx is not None:
+                for txin in tx.inputs():
+                    if txin.get('is_coinbase'):
+                        continue
+                    ser = txin['prevout_hash'] + ':%d' % txin['prevout_n']
+                    if self.pruned_txo.get(ser) == tx_hash:
+                        self.pruned_txo.pop(ser)
+            else:
+                for ser, hh in self.pruned_txo.items():
+                    if hh == tx_hash:
+                        self.pruned_txo.pop(ser)
+            # the outpoints of tx spent by wallet transactions are no
+            # longer known: add them to pruned_txo, and undo the txi
+            # addition
+            for ser in self.spent_outpoints.pop(tx_hash, set()):
+                for next_tx in self.spent_by.pop(ser, set()):
+                    dd = self.txi.get(next_tx, {})
+                    for addr, l in dd.items():
+                        for item in l[:]:
+                            if item[0] == ser:
+                                l.remove(item)
+                                self.pruned_txo[ser] = next_tx
+                                self.invalidate_balances([addr])
+                                self.invalidate_history([next_tx])
+                        if l == []:
+                            dd.pop(addr)
+            # tx no longer spends its inputs
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self.remove_spend(ser, tx_hash)
+            self.invalidate_balances(self.txi.get(tx_hash, {}).keys() + self.txo.get(tx_hash, {}).keys())
+            self.invalidate_history([tx_hash])
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
@@ -677,6 +954,8 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self.history[addr] = hist
+        self.invalidate_balances([addr])
+        self.invalidate_history([tx_hash for tx_hash, height in old_hist + hist])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -693,10 +972,87 @@ class Abstract_Wallet(PrintError):
         # Store fees
         self.tx_fees.update(tx_fees)
 
-    def get_history(self, domain=None):
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
+    def clear_history_cache(self):
+        with self.history_lock:
+            # entries (txpos, tx_hash, delta), sorted
+            self.history_entries = []
+            # tx hash -> its entry
+            self.history_index = {}
+            # running balance after each entry, valid below history_valid
+            self.history_balances = []
+            self.history_valid = 0
+            self.history_unknown_deltas = 0
+            self.dirty_txs = set(self.tx_addr_hist.keys())
+
+    def invalidate_history(self, tx_hashes):
+        with self.history_lock:
+            self.dirty_txs.update(tx_hashes)
+
+    def update_history(self):
+        '''Move the entries of the transactions touched since the last
+        call to their current position'''
+        with self.history_lock:
+            dirty, self.dirty_txs = self.dirty_txs, set()
+            for tx_hash in dirty:
+                old = self.history_index.pop(tx_hash, None)
+                if old is not None:
+                    i = bisect.bisect_left(self.history_entries, old)
+                    del self.history_entries[i]
+                    self.history_valid = min(self.history_valid, i)
+                    if old[2] is None:
+                        self.history_unknown_deltas -= 1
+                addrs = [a for a in self.tx_addr_hist.get(tx_hash, []) if a in self.address_index]
+                if not addrs:
+                    continue
+                delta = 0
+                for addr in addrs:
+                    d = self.get_tx_delta(tx_hash, addr)
+                    if d is None:
+                        delta = None
+                        break
+                    delta += d
+                entry = (self.get_txpos(tx_hash), tx_hash, delta)
+                i = bisect.bisect_left(self.history_entries, entry)
+                self.history_entries.insert(i, entry)
+                self.history_index[tx_hash] = entry
+                self.history_valid = min(self.history_valid, i)
+                if delta is None:
+                    self.history_unknown_deltas += 1
+            del self.history_balances[self.history_valid:]
+
+    def get_history(self, domain=None, start=0, end=None):
+        '''Wallet history in increasing order, as tuples (tx_hash, height,
+        conf, timestamp, delta, balance).  start and end select a slice.
+        The history of the whole wallet is maintained incrementally;
+        other domains are computed from scratch.'''
+        if domain is not None:
+            return self.compute_history(domain)[start:end]
+        self.update_history()
+        with self.history_lock:
+            entries = self.history_entries
+            if self.history_unknown_deltas:
+                # running balances are only known after the last
+                # unknown delta
+                return self.compute_history(self.get_addresses())[start:end]
+            balances = self.history_balances
+            b = balances[-1] if balances else 0
+            for txpos, tx_hash, delta in entries[len(balances):]:
+                b += delta
+                balances.append(b)
+            self.history_valid = len(balances)
+            c, u, x = self.get_balance()
+            if balances and balances[-1] != c + u + x:
+                # fixme: this may happen if history is incomplete
+                self.print_error("Error: history not synchronized")
+                return []
+            out = []
+            for i in range(len(entries))[start:end]:
+                txpos, tx_hash, delta = entries[i]
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                out.append((tx_hash, height, conf, timestamp, delta, balances[i]))
+            return out
+
+    def compute_history(self, domain):
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -715,7 +1071,7 @@ class Abstract_Wallet(PrintError):
             delta = tx_deltas[tx_hash]
             height, conf, timestamp = self.get_tx_height(tx_hash)
             history.append((tx_hash, height, conf, timestamp, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]))
+        history.sort(key = lambda x: (self.get_txpos(x[0]), x[0]))
         history.reverse()
 
         # 3. add balance
@@ -963,8 +1319,10 @@ class Abstract_Wallet(PrintError):
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
+        self.save_derived_indexes()
         self.storage.put('verified_tx3', self.verified_tx)
         self.storage.write()
+        self.storage.compact()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1295,6 +1653,7 @@ class Abstract_Wallet(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+        self.invalidate_balances([address])
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -1358,6 +1717,7 @@ class Imported_Wallet(Abstract_Wallet):
         if address in self.addresses:
             return
         self.addresses.append(address)
+        self.address_index[address] = (False, len(self.addresses) - 1)
         self.storage.put('addresses', self.addresses)
         self.storage.write()
         self.add_address(address)
@@ -1370,6 +1730,9 @@ class Imported_Wallet(Abstract_Wallet):
         if address not in self.addresses:
             return
         self.addresses.remove(address)
+        self.build_address_index()
+        self.invalidate_balances([address])
+        self.invalidate_history([tx_hash for tx_hash, height in self.history.get(address, [])])
         self.storage.put('addresses', self.addresses)
         self.storage.write()
 
@@ -1462,6 +1825,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             n = len(addresses) - k + value
             self.receiving_pubkeys = self.receiving_pubkeys[0:n]
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_pubkeys()
@@ -1491,28 +1855,40 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
+        '''Derives count addresses in one batch; pubkeys are saved once'''
         pubkey_list = self.change_pubkeys if for_change else self.receiving_pubkeys
+        addr_list = self.change_addresses if for_change else self.receiving_addresses
         n = len(pubkey_list)
-        x = self.new_pubkeys(for_change, n)
-        pubkey_list.append(x)
+        pubkeys = self.new_pubkeys_batch(for_change, n, count)
+        addresses = map(self.pubkeys_to_address, pubkeys)
+        pubkey_list.extend(pubkeys)
+        addr_list.extend(addresses)
         self.save_pubkeys()
-        address = self.pubkeys_to_address(x)
-        addr_list = self.change_addresses if for_change else self.receiving_addresses
-        addr_list.append(address)
-        self.add_address(address)
-        return address
+        for i, address in enumerate(addresses):
+            self.address_index[address] = (for_change, n + i)
+            self.add_address(address)
+        return addresses
+
+    def new_pubkeys_batch(self, c, i, count):
+        return [self.new_pubkeys(c, i + k) for k in range(count)]
 
     def synchronize_sequence(self, for_change):
+        '''Extends the branch so that its last limit addresses are
+        unused.  The missing addresses are created in one batch.'''
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
-            addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if map(lambda a: self.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+        addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+        n = len(addresses)
+        last_used = -1
+        for i in range(n - 1, max(n - limit, 0) - 1, -1):
+            if self.address_is_old(addresses[i]):
+                last_used = i
                 break
-            else:
-                self.create_new_address(for_change)
+        count = max(limit - n, last_used + 1 + limit - n)
+        if count > 0:
+            self.create_new_addresses(for_change, count)
 
     def synchronize(self):
         with self.lock:
@@ -1524,6 +1900,7 @@ class Deterministic_Wallet(Abstract_Wallet):
                     self.receiving_pubkeys = self.keystore.keypairs.keys()
                     self.save_pubkeys()
                     self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
+                    self.build_address_index()
                     for addr in self.receiving_addresses:
                         self.add_address(addr)
 
@@ -1561,6 +1938,9 @@ class Standard_Wallet(Deterministic_Wallet, P2PKH_Wallet):
     def new_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def new_pubkeys_batch(self, c, i, count):
+        return self.keystore.derive_pubkeys(c, i, count)
+
     def get_keystore(self):
         return self.keystore
 
@@ -1594,6 +1974,9 @@ class Standard_Wallet(Deterministic_Wallet, P2PKH_Wallet):
         self.save_keystore()
         self.receiving_pubkeys.remove(pubkey)
         self.receiving_addresses.remove(address)
+        self.build_address_index()
+        self.invalidate_balances([address])
+        self.invalidate_history([tx_hash for tx_hash, height in self.history.get(address, [])])
         self.storage.write()
 
     def can_import_privkey(self):
@@ -1606,6 +1989,7 @@ class Standard_Wallet(Deterministic_Wallet, P2PKH_Wallet):
         self.save_pubkeys()
         addr = self.pubkeys_to_address(pubkey)
         self.receiving_addresses.append(addr)
+        self.address_index[addr] = (False, len(self.receiving_addresses) - 1)
         self.storage.write()
         self.add_address(addr)
         return addr
@@ -1636,6 +2020,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def new_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def new_pubkeys_batch(self, c, i, count):
+        l = [k.derive_pubkeys(c, i, count) for k in self.get_keystores()]
+        return map(list, zip(*l))
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
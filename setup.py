@@ -70,6 +70,7 @@ setup(
     package_data={
         'electrum': [
             'www/index.html',
+            'checkpoints*.json',
             'wordlist/*.txt',
             'locale/*/LC_MESSAGES/electrum.mo',
         ]